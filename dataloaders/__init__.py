@@ -1,3 +1,7 @@
 from dataloaders.dataloaders import *
 from dataloaders.samplers import *
+from dataloaders.readers import *
+from dataloaders.stores import *
+from dataloaders.indexes import *
 from dataloaders.plugins import *
+from dataloaders.profilers import *
@@ -1,30 +1,99 @@
 import tensorflow as tf
 import numpy as np
+import concurrent.futures
+import multiprocessing
+import threading
+import copy
+
+
+class Batch:
+    # the batch one __getitem__ call is filling, concurrent calls never share one
+    def __init__(self, arrays, size, sample_weights=False):
+        self.arrays = arrays
+        self.size = size
+        self.sample_idx = 0
+        self.weights = np.ones(size, dtype=np.float32) if sample_weights else None
+
+    @property
+    def full(self):
+        return self.sample_idx >= self.size
 
 
 class DataLoader(tf.keras.utils.Sequence):
-    def __init__(self, sampler, plugins, batch_size, labels="outlines", len_factor=1):
+    def __init__(
+        self, sampler, plugins, batch_size, labels="outlines", len_factor=1,
+        dtype=np.float32, labels_dtype=np.float32, n_buffers=None, sparse_labels=False,
+        profiler=None, sample_weights=False
+    ):
         self.sampler = sampler
         self.plugins = plugins
         self.batch_size = batch_size
         self.labels = labels
         self.len_factor = len_factor
+        self.dtype = dtype
+        self.labels_dtype = labels_dtype
+        # labels as uint8 class indices without the class axis instead of one-hot, for the
+        # sparse losses and metrics
+        self.sparse_labels = sparse_labels
+        self.profiler = profiler
+        # batches become (batch_x, batch_y, weights), with the weight of every sample, e.g.
+        # the importance correction of ImportanceSampler
+        self.sample_weights = sample_weights
+        self.signature = None
+        self.__allocate(n_buffers)
         self.__index()
 
+    def __allocate(self, n_buffers):
+        # every batch gets its own arrays by default. With n_buffers, batches are written into
+        # a ring of reusable per-feature buffers, a returned batch then stays valid only until
+        # the same thread has produced n_buffers further batches
+        self.n_buffers = n_buffers
+        self.__local = threading.local()
+
+    @property
+    def reuses_buffers(self):
+        return self.n_buffers is not None
+
+    def __next_buffer(self):
+        if self.n_buffers is None:
+            return {}
+        # rings are kept per thread, so concurrent calls never write into the same arrays
+        local = self.__local
+        if not hasattr(local, "buffers"):
+            local.buffers = [{} for _ in range(self.n_buffers)]
+            local.buffer_idx = 0
+        buffer = local.buffers[local.buffer_idx]
+        local.buffer_idx = (local.buffer_idx + 1) % self.n_buffers
+        return buffer
+
     def __index(self):
         self.sampler.set_dataloader(self)
+        self.__register_plugins()
+        for plugin in self.before_indexing_plugins:
+            self.__run("before_indexing", plugin, plugin.before_indexing, self.sampler)
+        self.__run("index", self.sampler, self.sampler.index)
+        for plugin in self.after_indexing_plugins:
+            self.__run("after_indexing", plugin, plugin.after_indexing, self.sampler)
+
+    @property
+    def current_batch(self):
+        # the batch the calling thread's __getitem__ is filling, for on_sampling plugins
+        return getattr(self.__local, "batch", None)
+
+    def __run(self, stage, target, function, *args):
+        if self.profiler is None:
+            return function(*args)
+        with self.profiler.record(stage, type(target).__name__):
+            return function(*args)
+
+    def __register_plugins(self):
         self.before_indexing_plugins = []
         self.after_indexing_plugins = []
         self.on_sampling_plugins = []
         self.on_finalising_plugins = []
         for plugin in self.plugins:
             self.add_plugin(plugin)
-        for plugin in self.before_indexing_plugins:
-            plugin.before_indexing(self.sampler)
-        self.sampler.index()
-        for plugin in self.after_indexing_plugins:
-            plugin.after_indexing(self.sampler)
-    
+
     def __index_plugin(self, plugin):
         if plugin.has_before_indexing_behaviour:
             self.before_indexing_plugins.append(plugin)
@@ -39,33 +108,225 @@ class DataLoader(tf.keras.utils.Sequence):
         plugin.set_dataloader(self)
         self.__index_plugin(plugin)
 
+    def clone(self, n_buffers=None):
+        # an already indexed copy with its own sampler state and file handles, indexing
+        # hooks are not run again
+        dataloader = copy.copy(self)
+        dataloader.__allocate(n_buffers or self.n_buffers)
+        dataloader.sampler = self.sampler.reopen()
+        dataloader.sampler.set_dataloader(dataloader)
+        dataloader.plugins = [copy.copy(plugin) for plugin in self.plugins]
+        dataloader.__register_plugins()
+        return dataloader
+
     def __len__(self):
         return self.sampler.n_patches // self.batch_size * self.len_factor
 
+    def output_signature(self):
+        # made once from a batch of a clone, with the global random state put back afterwards,
+        # so the batches this dataloader draws are the same as without it
+        if self.signature is None:
+            random_state = np.random.get_state()
+            batch = self.clone()[0]
+            np.random.set_state(random_state)
+            self.signature = tf.nest.map_structure(
+                lambda array: tf.TensorSpec(shape=array.shape, dtype=array.dtype), batch
+            )
+        return self.signature
+
+    def patch_index(self, idx, sample_idx):
+        # the sampler patch behind slot sample_idx of batch idx. Plugins that add samples
+        # scale n_patches, e.g. RepeatWithMandatoryTransformations fills two slots per patch
+        return (idx * self.batch_size + sample_idx) * len(self.sampler.patches) // self.sampler.n_patches
+
     def __getitem__(self, idx):
-        if idx == 0:
+        indexable = self.sampler.indexable
+        if idx == 0 and not indexable:
             self.sampler.reset()
-        self.batch_list = []
-        self.sample_idx = 0
-        while self.sample_idx < self.batch_size:
-            sample = self.sampler.sample()
+        # all per-call state lives in batch, so indexable samplers can be served by many threads
+        batch = Batch(self.__next_buffer(), self.batch_size, self.sample_weights)
+        self.__local.batch = batch
+        direct = not (self.on_sampling_plugins or self.sparse_labels or self.sample_weights)
+        # indexable samplers make batch idx the same whatever was requested before it
+        draw = self.sampler.sample_at if indexable else self.sampler.sample
+        while not batch.full:
+            patch_idx = (self.patch_index(idx, batch.sample_idx), ) if indexable else ()
+            if batch.arrays and direct:
+                self.__run(
+                    "sample_into", self.sampler, self.sampler.sample_into, batch.arrays, batch.sample_idx, *patch_idx
+                )
+                batch.sample_idx += 1
+                continue
+            sample = self.__run("sample", self.sampler, draw, *patch_idx)
             for plugin in self.on_sampling_plugins:
-                sample = plugin.on_sampling(sample)
-            self.batch_list.append(sample)
-            self.sample_idx += 1
-        batch_x, batch_y = self.__reformat(self.batch_list)
+                sample = self.__run("on_sampling", plugin, plugin.on_sampling, sample)
+            # lazy patches are read here
+            self.__run("put", self, self.put, sample, batch)
+        self.__local.batch = None
+        batch_x = {_: batch.arrays[_] for _ in batch.arrays if _ != self.labels}
+        batch_y = batch.arrays[self.labels]
         for plugin in self.on_finalising_plugins:
-            batch_x, batch_y = plugin.on_finalising(batch_x, batch_y)
-        return batch_x, batch_y
-        
-    def __reformat(self, batch_list):
-        features = batch_list[0].keys()
-        batch = {}
-        for feature in features:
-            feature_list = []
-            for item in batch_list:
-                feature_list.append(item[feature])
-            batch[feature] = np.array(feature_list)
-        batch_x = {_: batch[_] for _ in batch if _ != self.labels}
-        batch_y = batch[self.labels]
+            batch_x, batch_y = self.__run("on_finalising", plugin, plugin.on_finalising, batch_x, batch_y)
+        if self.sample_weights:
+            return batch_x, batch_y, batch.weights
         return batch_x, batch_y
+
+    def put(self, sample, batch=None):
+        batch = self.current_batch if batch is None else batch
+        if batch.full:
+            return
+        # lazy patches are read straight into their slot, already flipped and rotated
+        lazy = hasattr(sample, "materialize_into")
+        features = []
+        for feature in sample:
+            sparse = self.sparse_labels and feature == self.labels
+            if feature not in batch.arrays:
+                dtype = self.labels_dtype if feature == self.labels else self.dtype
+                shape = sample.shape(feature) if lazy else sample[feature].shape
+                if sparse:
+                    dtype, shape = np.uint8, shape[:-1]
+                batch.arrays[feature] = np.empty((batch.size, ) + shape, dtype=dtype)
+            if sparse:
+                batch.arrays[feature][batch.sample_idx] = np.argmax(sample[feature], axis=-1)
+            elif lazy:
+                features.append(feature)
+            else:
+                batch.arrays[feature][batch.sample_idx] = sample[feature]
+        if lazy:
+            sample.materialize_into(batch.arrays, batch.sample_idx, features)
+        if self.sample_weights:
+            batch.weights[batch.sample_idx] = getattr(sample, "weight", 1.0)
+        batch.sample_idx += 1
+
+
+_worker_state = threading.local()
+
+
+def _init_worker(dataloader, reseed, n_buffers):
+    if reseed:
+        np.random.seed()
+    _worker_state.dataloader = dataloader.clone(n_buffers)
+
+
+def _load_batch(idx):
+    return _worker_state.dataloader[idx]
+
+
+class PrefetchingDataLoader(tf.keras.utils.Sequence):
+    def __init__(self, dataloader, n_workers=4, queue_size=8, use_processes=False, ordered=True):
+        self.dataloader = dataloader
+        self.n_workers = n_workers
+        self.queue_size = queue_size
+        self.use_processes = use_processes
+        self.ordered = ordered
+        self.executor = None
+        self.futures = {}
+        self.next_idx = 0
+        self.served = set()
+
+    def start(self):
+        if self.executor is not None:
+            return
+        if self.use_processes:
+            # fork keeps the parent's dataloader out of pickling, each child reopens its files
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.n_workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_worker,
+                initargs=(self.dataloader, True, 1),
+            )
+        else:
+            # batches are handed over without a copy, so workers only reuse buffers when the
+            # dataloader itself does, and then need enough of them to cover the whole queue
+            # plus the one the consumer holds. In ordered mode a queued batch can wait for any
+            # number of others under a shuffled order, so every batch gets its own arrays
+            n_buffers = self.dataloader.n_buffers
+            if n_buffers is not None:
+                n_buffers = None if self.ordered else max(n_buffers, self.queue_size + 2)
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.n_workers,
+                initializer=_init_worker,
+                initargs=(self.dataloader, False, n_buffers),
+            )
+
+    def close(self):
+        if self.executor is None:
+            return
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        self.executor = None
+        self.futures = {}
+        self.served = set()
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __fill(self):
+        n_batches = len(self)
+        while len(self.futures) < self.queue_size:
+            if not self.ordered:
+                self.futures[self.next_idx] = self.executor.submit(_load_batch, self.next_idx % n_batches)
+                self.next_idx += 1
+                continue
+            if self.next_idx >= n_batches:
+                return
+            # batches already queued or handed out in this pass are not scheduled again
+            if self.next_idx not in self.futures and self.next_idx not in self.served:
+                self.futures[self.next_idx] = self.executor.submit(_load_batch, self.next_idx)
+            self.next_idx += 1
+
+    def __getitem__(self, idx):
+        self.start()
+        if not self.ordered:
+            # samplers that ignore idx are served from whatever batch was scheduled first
+            self.__fill()
+            idx = next(iter(self.futures))
+        else:
+            if idx in self.served:
+                # a new pass over the batches, e.g. evaluate without on_epoch_end
+                self.served = set()
+                self.next_idx = idx
+            if idx not in self.futures:
+                # a shuffled Sequence order misses the look-ahead, the requested batch is
+                # scheduled on its own and the queued ones are kept until they are asked for
+                self.futures[idx] = self.executor.submit(_load_batch, idx)
+            self.served.add(idx)
+        future = self.futures.pop(idx)
+        self.__fill()
+        return future.result()
+
+    def on_epoch_end(self):
+        self.dataloader.on_epoch_end()
+        self.served = set()
+        self.next_idx = 0
+
+    def output_signature(self):
+        return self.dataloader.output_signature()
+
+    @property
+    def reuses_buffers(self):
+        # batches from processes are unpickled copies, ordered thread workers never reuse buffers
+        return self.dataloader.reuses_buffers and not (self.use_processes or self.ordered)
+
+    def as_dataset(self):
+        return sequence_dataset(self)
+
+
+def sequence_dataset(sequence):
+    # one pass over a DataLoader or PrefetchingDataLoader. Tensors made from the yielded arrays
+    # can share their memory and tf.data can hold on to more batches than a ring of reused
+    # buffers has, so batches are copied before the next one is read when buffers are reused
+    output_signature = sequence.output_signature()
+    copy_batches = getattr(sequence, "reuses_buffers", True)
+
+    def generator():
+        for idx in range(len(sequence)):
+            batch = sequence[idx]
+            yield tf.nest.map_structure(np.copy, batch) if copy_batches else batch
+
+    dataset = tf.data.Dataset.from_generator(generator, output_signature=output_signature)
+    return dataset.prefetch(tf.data.AUTOTUNE)
@@ -1,4 +1,44 @@
+import dataloaders.indexes
+import numpy as np
+
+
+# filters are called with a tile group, filters with an evaluate attribute can also be
+# evaluated over a whole TileIndex at once, which TileFilter prefers
+
+
+def vectorized_filter(evaluate):
+    def filter(tile_group):
+        return bool(evaluate(dataloaders.indexes.describe_tiles([tile_group]))[0])
+    filter.evaluate = evaluate
+    return filter
+
+
 def region_filter(regions):
     def filter(tile_group):
         return (tile_group.name[1:].split('-')[0] in regions)
+    filter.evaluate = lambda index: np.isin(index["region"], list(regions))
     return filter
+
+
+def range_filter(column, minimum=None, maximum=None):
+    def evaluate(index):
+        values = index[column]
+        mask = np.ones(len(values), dtype=bool)
+        if minimum is not None:
+            mask &= values >= minimum
+        if maximum is not None:
+            mask &= values <= maximum
+        return mask
+    return vectorized_filter(evaluate)
+
+
+def class_fraction_filter(class_id=1, minimum=None, maximum=None):
+    def evaluate(index):
+        values = index["class_fractions"][:, class_id]
+        mask = np.ones(len(values), dtype=bool)
+        if minimum is not None:
+            mask &= values >= minimum
+        if maximum is not None:
+            mask &= values <= maximum
+        return mask
+    return vectorized_filter(evaluate)
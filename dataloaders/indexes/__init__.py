@@ -0,0 +1 @@
+from dataloaders.indexes.indexes import *
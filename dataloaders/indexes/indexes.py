@@ -0,0 +1,110 @@
+import numpy as np
+import h5py
+import os
+
+
+INDEX_VERSION = 1
+
+_indexes = {}
+
+
+def parse_codename(codename):
+    # codenames are <region>-<row>-<col>, e.g. HMA-110-78
+    parts = codename.split("-")
+    try:
+        row, col = int(parts[-2]), int(parts[-1])
+    except (IndexError, ValueError):
+        row, col = -1, -1
+    return parts[0], row, col
+
+
+def describe_tiles(tile_groups, labels="outlines"):
+    columns = {
+        "codename": [], "region": [], "row": [], "col": [], "height": [], "width": [],
+        "pad_height": [], "pad_width": [], "class_fractions": [],
+    }
+    for tile_group in tile_groups:
+        codename = tile_group.name.split("/")[-1]
+        region, row, col = parse_codename(codename)
+        attrs = tile_group.attrs
+        height, width = int(attrs["height"]), int(attrs["width"])
+        pad_height, pad_width = int(attrs["pad_height"]), int(attrs["pad_width"])
+        # class fractions over the tile without its padding stripes
+        outlines = tile_group[labels][pad_height:pad_height + height, pad_width:pad_width + width, :]
+        counts = np.sum(outlines, axis=(0, 1), dtype=np.int64)
+        for column, value in (
+            ("codename", codename), ("region", region), ("row", row), ("col", col),
+            ("height", height), ("width", width), ("pad_height", pad_height), ("pad_width", pad_width),
+            ("class_fractions", counts / max(height * width, 1)),
+        ):
+            columns[column].append(value)
+    return TileIndex({column: np.array(values) for column, values in columns.items()})
+
+
+class TileIndex:
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __len__(self):
+        return len(self.columns["codename"])
+
+    def select(self, mask):
+        return list(self.columns["codename"][mask])
+
+
+def _paths(dataset, suffix):
+    # the source file whose stat invalidates the cache, and where the cache is stored
+    if isinstance(dataset, (h5py.File, h5py.Group)):
+        return dataset.file.filename, f"{dataset.file.filename}.{suffix}.npz"
+    return os.path.join(dataset.path, "index.json"), os.path.join(dataset.path, f"{suffix}.npz")
+
+
+def cached_arrays(dataset, suffix, build):
+    # arrays derived from a dataset are built once per dataset file and kept next to it,
+    # they are rebuilt when the file changes
+    source_path, cache_path = _paths(dataset, suffix)
+    stat = os.stat(source_path)
+    meta = {"version": INDEX_VERSION, "name": dataset.name, "mtime": stat.st_mtime, "size": stat.st_size}
+    key = (cache_path, ) + tuple(meta.values())
+    if key in _indexes:
+        return _indexes[key]
+    arrays = None
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            if {_: data[_].item() for _ in meta if _ in data.files} == meta:
+                arrays = {_: data[_] for _ in data.files if _ not in meta}
+    if arrays is None:
+        arrays = build()
+        try:
+            np.savez(cache_path, **meta, **arrays)
+        except OSError:
+            pass
+    _indexes[key] = arrays
+    return arrays
+
+
+def tile_index(dataset, labels="outlines"):
+    columns = cached_arrays(
+        dataset, f"tiles_{labels}", lambda: describe_tiles([dataset[tile] for tile in dataset.keys()], labels).columns
+    )
+    return TileIndex(columns)
+
+
+def fraction_grid(outlines, class_id=1, cell_size=64):
+    # fraction of class_id pixels in every cell_size x cell_size cell, cells at the border
+    # are partial and padded with zeros
+    height, width, _ = outlines.shape
+    n_rows, n_cols = -(-height // cell_size), -(-width // cell_size)
+    mask = np.zeros((n_rows * cell_size, n_cols * cell_size), dtype=np.float32)
+    mask[:height, :width] = outlines[:, :, class_id]
+    return mask.reshape((n_rows, cell_size, n_cols, cell_size)).mean(axis=(1, 3))
+
+
+def fraction_grids(dataset, labels="outlines", class_id=1, cell_size=64):
+    return cached_arrays(
+        dataset, f"fractions_{labels}_{class_id}_{cell_size}",
+        lambda: {tile: fraction_grid(dataset[tile][labels], class_id, cell_size) for tile in dataset.keys()}
+    )
@@ -1,5 +1,7 @@
 import abc
 import dataloaders.transformations
+import dataloaders.indexes
+import utils.misc
 import numpy as np
 
 
@@ -38,15 +40,23 @@ class TileFilter(Plugin):
     def before_indexing(self, sampler):
         dataset = sampler.dataset
         tiles = sampler.tiles
-        filtered_tiles = []
-        for tile in tiles:
-            tile_group = dataset[tile]
-            if self.apply_filters(tile_group):
-                filtered_tiles.append(tile)
-        sampler.tiles = filtered_tiles
-
-    def apply_filters(self, tile_group):
-        filter_outputs = [filter(tile_group) for filter in self.filters]
+        # vectorized filters run over the cached tile index without opening any group
+        vectorized = [filter for filter in self.filters if hasattr(filter, "evaluate")]
+        if vectorized:
+            index = dataloaders.indexes.tile_index(dataset, getattr(sampler, "labels", "outlines"))
+            mask = np.ones(len(index), dtype=bool)
+            for filter in vectorized:
+                mask &= filter.evaluate(index)
+            selected = set(index.select(mask))
+            tiles = [tile for tile in tiles if tile in selected]
+        remaining = [filter for filter in self.filters if not hasattr(filter, "evaluate")]
+        if remaining:
+            tiles = [tile for tile in tiles if self.apply_filters(dataset[tile], remaining)]
+        sampler.tiles = tiles
+
+    def apply_filters(self, tile_group, filters=None):
+        filters = self.filters if filters is None else filters
+        filter_outputs = [filter(tile_group) for filter in filters]
         return all(filter_outputs)
 
 
@@ -61,6 +71,20 @@ class Augmentation(Plugin):
         return sample
 
 
+class BatchAugmentation(Plugin):
+    def __init__(self, transformations):
+        self.transformations = transformations
+
+    def on_finalising(self, batch_x, batch_y):
+        labels = self.dataloader.labels
+        # sparse labels get a class axis, so they are transformed together with the features
+        sparse = batch_y.ndim == 3
+        batch = dict(batch_x, **{labels: batch_y[..., np.newaxis] if sparse else batch_y})
+        dataloaders.transformations.apply_batch_transformations(batch, self.transformations)
+        batch_y = batch.pop(labels)
+        return batch, batch_y[..., 0] if sparse else batch_y
+
+
 class AddDeepSupervision(Plugin):
     def __init__(self, n_branches=2):
         self.n_branches = n_branches
@@ -78,10 +102,25 @@ class RepeatWithMandatoryTransformations(Plugin):
         sampler.n_patches *= 2
 
     def on_sampling(self, sample):
-        sample_copy = {key: value.copy() for key, value in sample.items()}
+        # transformations never write into the arrays, so a shallow copy of the sample is enough
+        sample_copy = sample.copy()
         dataloaders.transformations.apply_transformations(
             sample_copy, self.transformations
         )
-        self.dataloader.batch_list.append(sample_copy)
-        self.dataloader.sample_idx += 1
+        self.dataloader.put(sample_copy)
         return sample
+
+
+class Normalization(Plugin):
+    def __init__(self, mins, maxs, features=["features"]):
+        self.mins = np.asarray(mins)
+        self.maxs = np.asarray(maxs)
+        self.features = features
+
+    def on_finalising(self, batch_x, batch_y):
+        # raw subsets carry NaN in padding and invalid pixels, which end up 0 as at inference
+        for feature in self.features:
+            array = batch_x[feature]
+            out = array if array.dtype.kind == "f" else None
+            batch_x[feature] = utils.misc.normalize(array, self.mins, self.maxs, out=out)
+        return batch_x, batch_y
@@ -0,0 +1 @@
+from dataloaders.profilers.profilers import *
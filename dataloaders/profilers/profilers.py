@@ -0,0 +1,75 @@
+import collections
+import contextlib
+import tracemalloc
+import threading
+import time
+import json
+import os
+
+
+class Profiler:
+    def __init__(self, trace_memory=False, max_events=100000):
+        self.trace_memory = trace_memory
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.reset()
+
+    def reset(self):
+        # (stage, name) -> [calls, seconds, bytes]
+        self.stats = collections.defaultdict(lambda: [0, 0.0, 0])
+        self.events = []
+        self.start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def record(self, stage, name):
+        if self.trace_memory:
+            # the peak is global, with several worker threads allocations overlap
+            tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            n_bytes = tracemalloc.get_traced_memory()[1] - start_bytes if self.trace_memory else 0
+            with self.lock:
+                stats = self.stats[(stage, name)]
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] += n_bytes
+                if len(self.events) < self.max_events:
+                    self.events.append((stage, name, start, elapsed, threading.get_ident(), n_bytes))
+
+    def summary(self):
+        rows = [("stage", "name", "calls", "total [s]", "mean [ms]", "allocated [MB]")]
+        total = sum(seconds for _, seconds, _ in self.stats.values())
+        for (stage, name), (calls, seconds, n_bytes) in sorted(self.stats.items(), key=lambda _: -_[1][1]):
+            rows.append((
+                stage, name, str(calls), f"{seconds:.3f}", f"{1000 * seconds / calls:.3f}",
+                f"{n_bytes / 2**20:.1f}" if self.trace_memory else "-",
+            ))
+        rows.append(("total", "", "", f"{total:.3f}", "", ""))
+        widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+        return "\n".join("  ".join(value.ljust(width) for value, width in zip(row, widths)) for row in rows)
+
+    def trace_events(self):
+        # complete events of the Chrome trace format, open in chrome://tracing or Perfetto
+        return [
+            {
+                "name": name,
+                "cat": stage,
+                "ph": "X",
+                "ts": (start - self.start_time) * 1e6,
+                "dur": elapsed * 1e6,
+                "pid": os.getpid(),
+                "tid": thread,
+                "args": {"bytes": n_bytes},
+            }
+            for stage, name, start, elapsed, thread, n_bytes in self.events
+        ]
+
+    def save_trace(self, path):
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": self.trace_events()}, trace_file)
@@ -0,0 +1 @@
+from dataloaders.readers.readers import *
@@ -0,0 +1,124 @@
+import numpy as np
+import h5py
+import collections
+import threading
+
+
+class PatchReader:
+    def read(self, dataset, y, x, size, out=None):
+        selection = np.s_[y:y + size, x:x + size, :]
+        if out is None:
+            return dataset[selection]
+        if isinstance(dataset, h5py.Dataset) and out.flags.c_contiguous:
+            # HDF5 converts to the dtype of out while reading, no intermediate array is made
+            dataset.read_direct(out, selection)
+        else:
+            out[...] = dataset[selection]
+        return out
+
+
+class ChunkCache:
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.chunks = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        n_requests = self.hits + self.misses
+        return self.hits / n_requests if n_requests else 0.0
+
+    def get(self, key):
+        with self.lock:
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.chunks.move_to_end(key)
+            return chunk
+
+    def put(self, key, chunk):
+        if chunk.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.chunks:
+                return
+            self.chunks[key] = chunk
+            self.n_bytes += chunk.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self.chunks.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.chunks.clear()
+            self.n_bytes = 0
+
+
+class CachedPatchReader(PatchReader):
+    def __init__(self, cache=None, max_bytes=512 * 2**20):
+        self.cache = cache if cache is not None else ChunkCache(max_bytes)
+
+    def read(self, dataset, y, x, size, out=None):
+        if not isinstance(dataset, h5py.Dataset) or dataset.chunks is None:
+            return super(CachedPatchReader, self).read(dataset, y, x, size, out)
+        height, width, depth = dataset.shape
+        chunk_height, chunk_width, chunk_depth = dataset.chunks
+        if out is None:
+            out = np.empty((size, size, depth), dtype=dataset.dtype)
+        # one decoded chunk serves every patch that overlaps it, across tiles and samplers
+        key = (dataset.file.filename, dataset.name)
+        for chunk_y in range(y // chunk_height * chunk_height, y + size, chunk_height):
+            top, bottom = max(y, chunk_y), min(y + size, chunk_y + chunk_height)
+            for chunk_x in range(x // chunk_width * chunk_width, x + size, chunk_width):
+                left, right = max(x, chunk_x), min(x + size, chunk_x + chunk_width)
+                for chunk_z in range(0, depth, chunk_depth):
+                    chunk = self.read_chunk(dataset, key, chunk_y, chunk_x, chunk_z)
+                    out[top - y:bottom - y, left - x:right - x, chunk_z:chunk_z + chunk_depth] = chunk[
+                        top - chunk_y:bottom - chunk_y, left - chunk_x:right - chunk_x, :
+                    ]
+        return out
+
+    def read_chunk(self, dataset, key, chunk_y, chunk_x, chunk_z):
+        chunk_key = key + (chunk_y, chunk_x, chunk_z)
+        chunk = self.cache.get(chunk_key)
+        if chunk is None:
+            chunk_height, chunk_width, chunk_depth = dataset.chunks
+            chunk = dataset[
+                chunk_y:chunk_y + chunk_height,
+                chunk_x:chunk_x + chunk_width,
+                chunk_z:chunk_z + chunk_depth
+            ]
+            self.cache.put(chunk_key, chunk)
+        return chunk
+
+
+def expected_chunk_reads(shape, chunks, patch_size, neighbourhood=None, block_size=1):
+    # expected number of chunks decoded per patch when every chunk of a neighbourhood is
+    # decoded once and then served from the cache for the rest of its block of patches
+    height, width, depth = shape
+    if chunks is None:
+        chunks = (height, width, depth)
+    chunk_height, chunk_width, chunk_depth = chunks
+    n_depth = -(-depth // chunk_depth)
+    per_patch = ((patch_size - 1) / chunk_height + 1) * ((patch_size - 1) / chunk_width + 1) * n_depth
+    if neighbourhood is None or block_size <= 1:
+        return per_patch
+    # neighbourhoods start on the chunk grid
+    per_block = -(-neighbourhood // chunk_height) * -(-neighbourhood // chunk_width) * n_depth
+    return min(per_patch, per_block / block_size)
+
+
+def expected_read_bytes(dataset, patch_size, neighbourhood=None, block_size=1):
+    if not isinstance(dataset, h5py.Dataset) or dataset.chunks is None:
+        return patch_size * patch_size * dataset.shape[2] * dataset.dtype.itemsize
+    chunk_bytes = np.prod(dataset.chunks) * dataset.dtype.itemsize
+    n_chunks = expected_chunk_reads(dataset.shape, dataset.chunks, patch_size, neighbourhood, block_size)
+    return n_chunks * chunk_bytes
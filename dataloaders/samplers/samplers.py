@@ -1,24 +1,119 @@
+import dataloaders.transformations
+import dataloaders.readers
+import dataloaders.indexes
 import numpy as np
+import h5py
+import copy
 import abc
 
 
+class LazyPatch:
+    # a patch that is only a location plus a pending flip/rotation until it is materialized,
+    # usually straight into its batch slot. Features that are read or replaced on the way,
+    # e.g. by crop_and_scale, are kept as arrays
+    def __init__(self, tile_group, y, x, size, features, reader):
+        self.tile_group = tile_group
+        self.y = y
+        self.x = x
+        self.size = size
+        self.features = features
+        self.reader = reader
+        self.weight = 1.0
+        self.element = dataloaders.transformations.IDENTITY
+        self.arrays = {}
+
+    def __iter__(self):
+        return iter(self.features)
+
+    def __len__(self):
+        return len(self.features)
+
+    def __contains__(self, feature):
+        return feature in self.features
+
+    def keys(self):
+        return list(self.features)
+
+    def items(self):
+        return [(feature, self[feature]) for feature in self.features]
+
+    def __getitem__(self, feature):
+        if feature not in self.arrays:
+            patch = self.reader.read(self.tile_group[feature], self.y, self.x, self.size)
+            self.arrays[feature] = dataloaders.transformations.apply_element(patch, self.element)
+        return self.arrays[feature]
+
+    def __setitem__(self, feature, value):
+        if feature not in self.features:
+            self.features = self.features + [feature]
+        self.arrays[feature] = value
+
+    def copy(self):
+        patch = copy.copy(self)
+        patch.arrays = dict(self.arrays)
+        return patch
+
+    def apply_element(self, element):
+        self.element = dataloaders.transformations.compose(self.element, element)
+        for feature, array in self.arrays.items():
+            self.arrays[feature] = dataloaders.transformations.apply_element(array, element)
+
+    def shape(self, feature):
+        if feature in self.arrays:
+            return self.arrays[feature].shape
+        return (self.size, self.size, self.tile_group[feature].shape[2])
+
+    def materialize_into(self, batch, idx, features=None):
+        for feature in self.features if features is None else features:
+            if feature in self.arrays:
+                batch[feature][idx] = self.arrays[feature]
+                continue
+            # reading into the inverse view of the slot leaves the transformed patch in the slot
+            out = dataloaders.transformations.apply_element(
+                batch[feature][idx], dataloaders.transformations.invert(self.element)
+            )
+            self.reader.read(self.tile_group[feature], self.y, self.x, self.size, out=out)
+
+
 class Sampler(abc.ABC):
-    def __init__(self, dataset, patch_size):
+    # indexable samplers draw patches from a patch index alone, see sample_at
+    indexable = False
+
+    def __init__(self, dataset, patch_size, reader=None):
         self.dataset = dataset
         self.tiles = list(dataset.keys())
         self.patch_size = patch_size
+        self.reader = reader if reader is not None else dataloaders.readers.PatchReader()
 
     def set_dataloader(self, dataloader):
         self.dataloader = dataloader
 
+    def reopen(self):
+        # a shallow copy with its own file handle, so that workers never share h5py state
+        sampler = copy.copy(self)
+        if isinstance(self.dataset, (h5py.File, h5py.Group)):
+            sampler.dataset = h5py.File(self.dataset.file.filename, "r")[self.dataset.name]
+        return sampler
+
     def index(self):
-        self.n_patches = 0 
+        # flat table of the non-overlapping patch grid of every tile, one (tile_id, y, x) row
+        # per patch, so a patch index maps to its patch without walking the tiles
         self.regions = set()
-        for tile in self.tiles:
+        patches = []
+        for tile_id, tile in enumerate(self.tiles):
             attrs = self.dataset[tile].attrs
-            height = attrs["height"] + 2 * attrs["pad_height"] + 1
-            width = attrs["width"] + 2 * attrs["pad_width"] + 1
-            self.n_patches += (height // self.patch_size) * (width // self.patch_size)
+            n_rows = (attrs["height"] + 2 * attrs["pad_height"] + 1) // self.patch_size
+            n_cols = (attrs["width"] + 2 * attrs["pad_width"] + 1) // self.patch_size
+            rows, cols = np.meshgrid(np.arange(n_rows), np.arange(n_cols), indexing="ij")
+            patches.append(np.stack([
+                np.full(rows.size, tile_id), rows.ravel() * self.patch_size, cols.ravel() * self.patch_size
+            ], axis=-1))
+        self.patches = np.concatenate(patches).astype(np.int32) if patches else np.zeros((0, 3), dtype=np.int32)
+        self.n_patches = len(self.patches)
+
+    def patch_at(self, idx):
+        tile_id, y, x = self.patches[idx % len(self.patches)]
+        return self.tiles[tile_id], int(y), int(x)
 
     def reset(self):
         pass
@@ -27,10 +122,23 @@ class Sampler(abc.ABC):
     def sample(self):
         raise NotImplementedError
 
+    def sample_at(self, patch_idx):
+        raise NotImplementedError
+
+    def sample_into(self, batch, idx, patch_idx=None):
+        sample = self.sample() if patch_idx is None else self.sample_at(patch_idx)
+        if isinstance(sample, LazyPatch):
+            sample.materialize_into(batch, idx)
+            return
+        for feature in batch:
+            batch[feature][idx] = sample[feature]
+
 
 class RandomSampler(Sampler):
-    def __init__(self, dataset, patch_size, features=["features"], labels="outlines"):
-        super(RandomSampler, self).__init__(dataset, patch_size)
+    def __init__(
+        self, dataset, patch_size, features=["features"], labels="outlines", reader=None
+    ):
+        super(RandomSampler, self).__init__(dataset, patch_size, reader)
         self.features = features
         self.labels = labels
 
@@ -43,58 +151,201 @@ class RandomSampler(Sampler):
         tile = np.random.choice(self.tiles)
         self.tile_group = self.dataset[tile]
 
-    def sample_patch(self):
+    def sample_location(self):
         height, width, _ = self.tile_group[self.features[0]].shape
         self.y = np.random.choice(height - self.patch_size)
         self.x = np.random.choice(width - self.patch_size)
-        self.patch = {}
-        for feature in self.features:
-            feature_patch = self.tile_group[feature][
-                self.y:self.y + self.patch_size, self.x:self.x + self.patch_size, :
-            ]
-            self.patch[feature] = feature_patch
-        self.patch[self.labels] = self.tile_group[self.labels][
-            self.y:self.y + self.patch_size, self.x:self.x + self.patch_size, :
-        ].astype(np.double)
+
+    def sample_patch(self):
+        self.sample_location()
+        self.patch = LazyPatch(
+            self.tile_group, self.y, self.x, self.patch_size, self.features + [self.labels], self.reader
+        )
 
 
 class ConsecutiveSampler(Sampler):
-    def __init__(self, dataset, patch_size, features=["features"], labels="outlines"):
-        super(ConsecutiveSampler, self).__init__(dataset, patch_size)
+    indexable = True
+
+    def __init__(
+        self, dataset, patch_size, features=["features"], labels="outlines", reader=None
+    ):
+        super(ConsecutiveSampler, self).__init__(dataset, patch_size, reader)
         self.features = features
         self.labels = labels
         self.reset()
 
     def reset(self):
-        self.tile_idx = 0
-        self.x = 0
-        self.y = 0
+        self.patch_idx = 0
 
     def sample(self):
-        self.sample_image()
-        height, width, _ = self.tile_group[self.features[0]].shape
-        if self.x + self.patch_size > width:
-            self.x = 0
-            self.y += self.patch_size
-        if self.y + self.patch_size > height:
-            self.y = 0
-            self.x = 0
-            self.tile_idx += 1
-            self.sample_image()
-        self.patch = {}
-        for feature in self.features:
-            feature_patch = self.tile_group[feature][
-                self.y:self.y + self.patch_size, self.x:self.x + self.patch_size, :
-            ]
-            self.patch[feature] = feature_patch
-        self.patch[self.labels] = self.tile_group[self.labels][
-            self.y:self.y + self.patch_size, self.x:self.x + self.patch_size, :
-        ].astype(np.double)
-        self.x += self.patch_size
+        self.patch = self.sample_at(self.patch_idx)
+        self.patch_idx += 1
         return self.patch
 
+    def sample_at(self, patch_idx):
+        # touches no sampler state, so batches do not depend on the order they are made in
+        tile, y, x = self.patch_at(patch_idx)
+        return LazyPatch(
+            self.dataset[tile], y, x, self.patch_size, self.features + [self.labels], self.reader
+        )
+
+
+class BlockRandomSampler(RandomSampler):
+    def __init__(
+        self, dataset, patch_size, features=["features"], labels="outlines", reader=None,
+        block_size=8, neighbourhood=None, n_blocks=1, max_read_bytes=None
+    ):
+        super(BlockRandomSampler, self).__init__(dataset, patch_size, features, labels, reader)
+        self.neighbourhood = neighbourhood if neighbourhood is not None else 2 * patch_size
+        self.n_blocks = n_blocks
+        self.locations = []
+        self.block_size = block_size
+        if max_read_bytes is not None:
+            self.block_size = self.block_size_for(max_read_bytes)
+
+    def reopen(self):
+        # the queued locations are sampler state, clones draw their own blocks
+        sampler = super(BlockRandomSampler, self).reopen()
+        sampler.locations = []
+        return sampler
+
     def sample_image(self):
-        if self.tile_idx >= len(self.tiles):
-            self.reset()
-        tile = self.tiles[self.tile_idx]
+        if not self.locations:
+            self.draw_blocks()
+        tile, self.y, self.x = self.locations.pop()
         self.tile_group = self.dataset[tile]
+
+    def sample_location(self):
+        pass
+
+    def draw_blocks(self):
+        # every block keeps block_size patches inside one chunk-aligned neighbourhood of a
+        # uniformly drawn tile, blocks are interleaved so consecutive samples are shuffled
+        for _ in range(self.n_blocks):
+            tile = np.random.choice(self.tiles)
+            dataset = self.dataset[tile][self.features[0]]
+            height, width, _ = dataset.shape
+            chunk_height, chunk_width, _ = getattr(dataset, "chunks", None) or (1, 1, 1)
+            span = max(self.neighbourhood - self.patch_size + 1, 1)
+            span_y = min(span, height - self.patch_size)
+            span_x = min(span, width - self.patch_size)
+            origin_y = np.random.choice(height - self.patch_size - span_y + 1)
+            origin_x = np.random.choice(width - self.patch_size - span_x + 1)
+            origin_y = origin_y // chunk_height * chunk_height
+            origin_x = origin_x // chunk_width * chunk_width
+            for _ in range(self.block_size):
+                y = origin_y + np.random.choice(span_y)
+                x = origin_x + np.random.choice(span_x)
+                self.locations.append((tile, y, x))
+        np.random.shuffle(self.locations)
+
+    def read_cost(self, block_size=None):
+        block_size = self.block_size if block_size is None else block_size
+        tile_group = self.dataset[self.tiles[0]]
+        return sum(
+            dataloaders.readers.expected_read_bytes(
+                tile_group[feature], self.patch_size, self.neighbourhood, block_size
+            )
+            for feature in self.features + [self.labels]
+        )
+
+    def block_size_for(self, max_read_bytes, max_block_size=1024):
+        block_size = 1
+        while block_size < max_block_size and self.read_cost(block_size) > max_read_bytes:
+            block_size += 1
+        return block_size
+
+
+def alias_table(weights):
+    # Vose's alias method, afterwards every draw is one uniform index and one coin flip
+    n = len(weights)
+    probs = np.asarray(weights, dtype=np.float64) * n / np.sum(weights)
+    alias = np.arange(n)
+    small = list(np.flatnonzero(probs < 1))
+    large = list(np.flatnonzero(probs >= 1))
+    while small and large:
+        less, more = small.pop(), large.pop()
+        alias[less] = more
+        probs[more] -= 1 - probs[less]
+        (small if probs[more] < 1 else large).append(more)
+    # whatever is left is 1 up to rounding
+    probs[small + large] = 1
+    return probs, alias
+
+
+def alias_draw(probs, alias):
+    idx = np.random.randint(len(probs))
+    return idx if np.random.random() < probs[idx] else alias[idx]
+
+
+class ImportanceSampler(RandomSampler):
+    def __init__(
+        self, dataset, patch_size, features=["features"], labels="outlines", reader=None,
+        class_id=1, cell_size=None, importance=None, background_weight=0.1
+    ):
+        super(ImportanceSampler, self).__init__(dataset, patch_size, features, labels, reader)
+        self.class_id = class_id
+        self.cell_size = cell_size if cell_size is not None else max(patch_size // 4, 1)
+        # maps the class fraction of patches to their relative weight
+        self.importance = importance if importance is not None else lambda fraction: fraction + background_weight
+
+    def index(self):
+        super(ImportanceSampler, self).index()
+        grids = dataloaders.indexes.fraction_grids(self.dataset, self.labels, self.class_id, self.cell_size)
+        cell_size = self.cell_size
+        n_cells = max(self.patch_size // cell_size, 1)
+        tiles, rows, cols, fractions, uniform = [], [], [], [], []
+        for tile_idx, tile in enumerate(self.tiles):
+            height, width, _ = self.dataset[tile][self.features[0]].shape
+            n_y, n_x = height - self.patch_size, width - self.patch_size
+            if n_y <= 0 or n_x <= 0:
+                continue
+            # class fraction of the patch starting at every cell, from an integral image of the grid
+            grid = grids[tile]
+            integral = np.pad(np.cumsum(np.cumsum(grid, axis=0), axis=1), ((1, n_cells), (1, n_cells)), mode="edge")
+            integral[0, :] = 0
+            integral[:, 0] = 0
+            cell_rows, cell_cols = -(-n_y // cell_size), -(-n_x // cell_size)
+            window = (
+                integral[n_cells:n_cells + cell_rows, n_cells:n_cells + cell_cols]
+                - integral[:cell_rows, n_cells:n_cells + cell_cols]
+                - integral[n_cells:n_cells + cell_rows, :cell_cols]
+                + integral[:cell_rows, :cell_cols]
+            ) / n_cells**2
+            # probability of every cell when the tile and the offset are drawn uniformly
+            origins_y = np.minimum(cell_size, n_y - np.arange(cell_rows) * cell_size)
+            origins_x = np.minimum(cell_size, n_x - np.arange(cell_cols) * cell_size)
+            cell_rows, cell_cols = np.meshgrid(np.arange(cell_rows), np.arange(cell_cols), indexing="ij")
+            tiles.append(np.full(cell_rows.size, tile_idx))
+            rows.append(cell_rows.ravel())
+            cols.append(cell_cols.ravel())
+            fractions.append(window.ravel())
+            uniform.append(np.outer(origins_y, origins_x).ravel() / (n_y * n_x))
+        self.candidate_tiles = np.concatenate(tiles)
+        self.candidate_rows = np.concatenate(rows)
+        self.candidate_cols = np.concatenate(cols)
+        self.fractions = np.concatenate(fractions)
+        uniform = np.concatenate(uniform) / len(tiles)
+        # sampling probabilities, and the weights p_uniform / p_importance that correct a
+        # loss back to the uniform distribution of RandomSampler
+        self.weights = self.importance(self.fractions) * uniform
+        self.weights = self.weights / self.weights.sum()
+        self.sample_weights = uniform / self.weights
+        self.probs, self.alias = alias_table(self.weights)
+
+    def sample_image(self):
+        candidate = alias_draw(self.probs, self.alias)
+        self.tile_group = self.dataset[self.tiles[self.candidate_tiles[candidate]]]
+        height, width, _ = self.tile_group[self.features[0]].shape
+        y = self.candidate_rows[candidate] * self.cell_size
+        x = self.candidate_cols[candidate] * self.cell_size
+        self.y = y + np.random.choice(min(self.cell_size, height - self.patch_size - y))
+        self.x = x + np.random.choice(min(self.cell_size, width - self.patch_size - x))
+        self.patch_weight = self.sample_weights[candidate]
+
+    def sample_location(self):
+        pass
+
+    def sample_patch(self):
+        super(ImportanceSampler, self).sample_patch()
+        self.patch.weight = self.patch_weight
@@ -0,0 +1 @@
+from dataloaders.stores.stores import *
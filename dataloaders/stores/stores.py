@@ -0,0 +1,122 @@
+import numpy as np
+import h5py
+import argparse
+import json
+import os
+
+
+INDEX_FILENAME = "index.json"
+INDEX_VERSION = 1
+
+
+class MemmapTile:
+    def __init__(self, store, tile):
+        self.store = store
+        self.name = f"/{tile}"
+        self.entry = store.index["tiles"][tile]
+        self.attrs = self.entry["attrs"]
+
+    def keys(self):
+        return self.entry["features"].keys()
+
+    def __contains__(self, feature):
+        return feature in self.entry["features"]
+
+    def __getitem__(self, feature):
+        # a zero-copy view into the feature's flat memory map
+        location = self.entry["features"][feature]
+        offset, shape = location["offset"], tuple(location["shape"])
+        return self.store.arrays[feature][offset:offset + int(np.prod(shape))].reshape(shape)
+
+
+class MemmapStore:
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, INDEX_FILENAME), "r") as index_file:
+            self.index = json.load(index_file)
+        if self.index["version"] != INDEX_VERSION:
+            raise ValueError(f"Unsupported store version {self.index['version']} in {path}")
+        self.arrays = {
+            feature: np.memmap(
+                os.path.join(path, f"{feature}.bin"), dtype=np.dtype(layout["dtype"]),
+                mode=mode, shape=(layout["size"], )
+            )
+            for feature, layout in self.index["features"].items()
+        }
+        self.name = "/"
+
+    def keys(self):
+        return self.index["tiles"].keys()
+
+    def __contains__(self, tile):
+        return tile in self.index["tiles"]
+
+    def __getitem__(self, tile):
+        return MemmapTile(self, tile)
+
+    def __len__(self):
+        return len(self.index["tiles"])
+
+    def flush(self):
+        for array in self.arrays.values():
+            array.flush()
+
+    def close(self):
+        self.flush()
+        self.arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _to_json(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def convert_hdf5(input_path, output_path, dtypes=None):
+    dtypes = dtypes or {}
+    os.makedirs(output_path, exist_ok=True)
+
+    # the first pass lays out every tile contiguously, the second one copies the data
+    index = {"version": INDEX_VERSION, "features": {}, "tiles": {}}
+    with h5py.File(input_path, "r") as src:
+        for tile in src.keys():
+            group = src[tile]
+            entry = {"attrs": {key: _to_json(value) for key, value in group.attrs.items()}, "features": {}}
+            for feature in group.keys():
+                dataset = group[feature]
+                layout = index["features"].setdefault(
+                    feature, {"dtype": np.dtype(dtypes.get(feature, dataset.dtype)).str, "size": 0}
+                )
+                entry["features"][feature] = {"offset": layout["size"], "shape": list(dataset.shape)}
+                layout["size"] += int(np.prod(dataset.shape))
+            index["tiles"][tile] = entry
+
+        with open(os.path.join(output_path, INDEX_FILENAME), "w") as index_file:
+            json.dump(index, index_file)
+
+        with MemmapStore(output_path, mode="w+") as store:
+            for tile in src.keys():
+                for feature, dataset in src[tile].items():
+                    dataset.read_direct(store[tile][feature])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", help="Path to input .hdf5 subset")
+    parser.add_argument("output_path", help="Path to output store directory")
+    parser.add_argument(
+        "--dtype", nargs=2, action="append", default=[], metavar=("FEATURE", "DTYPE"),
+        help="Store a feature with another dtype, e.g. --dtype features float32"
+    )
+    args = parser.parse_args()
+
+    convert_hdf5(args.input_path, args.output_path, dict(args.dtype))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,111 @@
+import tensorflow as tf
 import numpy as np
 import cv2
 
 
-def random_vertical_flip(p=0.5):
+# flips and rotations by multiples of 90 degrees form the dihedral group of order 8, every
+# element is stored as (transpose, flip_y, flip_x) applied in that order, so it is one view
+IDENTITY = (False, False, False)
+
+
+def compose(first, second):
+    transpose, flip_y, flip_x = first
+    if second[0]:
+        # a transpose after a flip turns it into a flip of the other axis
+        flip_y, flip_x = flip_x, flip_y
+    return (transpose != second[0], flip_y != second[1], flip_x != second[2])
+
+
+def invert(element):
+    transpose, flip_y, flip_x = element
+    if transpose:
+        return (True, flip_x, flip_y)
+    return element
+
+
+def apply_element(array, element):
+    transpose, flip_y, flip_x = element
+    if transpose:
+        array = array.swapaxes(0, 1)
+    return array[::-1 if flip_y else None, ::-1 if flip_x else None]
+
+
+def apply_element_to_patch(patch, element):
+    if element == IDENTITY:
+        return
+    if hasattr(patch, "apply_element"):
+        patch.apply_element(element)
+        return
+    for feature in patch:
+        if len(patch[feature].shape) != 3:
+            continue
+        patch[feature] = apply_element(patch[feature], element)
+
+
+# np.rot90(patch, k, axes=(1, 0)), a single clockwise turn is a transpose followed by flip_x
+ROTATIONS = [IDENTITY, (True, False, True)]
+for _ in range(2):
+    ROTATIONS.append(compose(ROTATIONS[-1], ROTATIONS[1]))
+
+
+def geometric_transformation(sample_element):
+    # sample_element draws the group element, apply_transformations folds runs of these
     def transform(patch):
-        if np.random.random() > p:
-            return
-        for feature in patch:
-            if len(patch[feature].shape) != 3:
-                continue
-            original = patch[feature]
-            transformed = np.flip(original, axis=0)
-            patch[feature] = transformed
+        apply_element_to_patch(patch, sample_element())
+    transform.sample_element = sample_element
     return transform
 
 
+def random_vertical_flip(p=0.5):
+    def sample_element():
+        if np.random.random() > p:
+            return IDENTITY
+        return (False, True, False)
+    return geometric_transformation(sample_element)
+
+
 def random_horizontal_flip(p=0.5):
-    def transform(patch):
+    def sample_element():
         if np.random.random() > p:
-            return
-        for feature in patch:
-            if len(patch[feature].shape) != 3:
-                continue
-            original = patch[feature]
-            transformed = np.flip(original, axis=1)
-            patch[feature] = transformed
-    return transform
+            return IDENTITY
+        return (False, False, True)
+    return geometric_transformation(sample_element)
 
 
 def random_rotation(p=0.75):
-    def transform(patch):
+    def sample_element():
         if np.random.random() > p:
-            return
+            return IDENTITY
         k = np.random.choice([1, 2, 3])
-        for feature in patch:
-            if len(patch[feature].shape) != 3:
-                continue
-            original = patch[feature]
-            transformed = np.rot90(original, k, axes=(1, 0))
-            patch[feature] = transformed
-    return transform
+        return ROTATIONS[k]
+    return geometric_transformation(sample_element)
 
 
-def crop_and_scale(patch_size, scale=0.8, p=0.5):
+# cv2 takes at most CV_CN_MAX channels per image and interpolates only some depths
+_MAX_CHANNELS = 512
+_RESIZABLE_DTYPES = {
+    cv2.INTER_LINEAR: (np.uint8, np.uint16, np.int16, np.float32, np.float64),
+    cv2.INTER_NEAREST_EXACT: (np.uint8, np.int8, np.uint16, np.int16, np.int32, np.float32, np.float64),
+}
+
+
+def resize(array, size, interpolation=cv2.INTER_LINEAR, out=None):
+    height, width = size
+    if out is None:
+        out = np.empty((height, width) + array.shape[2:], dtype=array.dtype)
+    if array.dtype.type not in _RESIZABLE_DTYPES[interpolation]:
+        array = array.astype(np.float32)
+    if array.ndim == 2:
+        out[...] = cv2.resize(array, (width, height), interpolation=interpolation)
+        return out
+    for start in range(0, array.shape[2], _MAX_CHANNELS):
+        chunk = cv2.resize(array[:, :, start:start + _MAX_CHANNELS], (width, height), interpolation=interpolation)
+        # cv2 drops a trailing axis of size 1
+        out[:, :, start:start + _MAX_CHANNELS] = chunk.reshape((height, width, -1))
+    return out
+
+
+def crop_and_scale(patch_size, scale=0.8, p=0.5, labels="outlines"):
     def transform(patch):
         if np.random.random() > p:
             return
@@ -53,20 +116,145 @@ def crop_and_scale(patch_size, scale=0.8, p=0.5):
         for feature in patch:
             if len(patch[feature].shape) != 3:
                 continue
-            original = patch[feature]
-            crop = original[y:y + new_size, x:x + new_size, :]
-            _, _, depth = crop.shape
-            transformed = np.empty((patch_size, patch_size, depth))
-            for channel_idx in range(depth):
-                transformed[:, :, channel_idx] = cv2.resize(
-                    crop[:, :, channel_idx], (patch_size, patch_size)
-                )
-            patch[feature] = transformed
+            crop = patch[feature][y:y + new_size, x:x + new_size, :]
+            interpolation = cv2.INTER_NEAREST_EXACT if feature == labels else cv2.INTER_LINEAR
+            patch[feature] = resize(crop, (patch_size, patch_size), interpolation)
     return transform
 
 
 def apply_transformations(patch, transformations):
     if not transformations:
-        return 
+        return
+    # consecutive flips and rotations are composed and applied as a single view, arrays are
+    # only copied when the sample is put into the batch buffer
+    element = IDENTITY
     for transformation in transformations:
+        if hasattr(transformation, "sample_element"):
+            element = compose(element, transformation.sample_element())
+            continue
+        apply_element_to_patch(patch, element)
+        element = IDENTITY
         transformation(patch)
+    apply_element_to_patch(patch, element)
+
+
+def batch_random_vertical_flip(p=0.5):
+    def transform(batch):
+        mask = np.random.random(len(next(iter(batch.values())))) < p
+        for feature in batch:
+            if len(batch[feature].shape) != 4:
+                continue
+            batch[feature][mask] = batch[feature][mask, ::-1]
+    return transform
+
+
+def batch_random_horizontal_flip(p=0.5):
+    def transform(batch):
+        mask = np.random.random(len(next(iter(batch.values())))) < p
+        for feature in batch:
+            if len(batch[feature].shape) != 4:
+                continue
+            batch[feature][mask] = batch[feature][mask, :, ::-1]
+    return transform
+
+
+def batch_random_rotation(p=0.75):
+    def transform(batch):
+        batch_size = len(next(iter(batch.values())))
+        ks = np.where(np.random.random(batch_size) < p, np.random.choice([1, 2, 3], batch_size), 0)
+        for feature in batch:
+            if len(batch[feature].shape) != 4:
+                continue
+            for k in (1, 2, 3):
+                mask = ks == k
+                if mask.any():
+                    batch[feature][mask] = np.rot90(batch[feature][mask], k, axes=(2, 1))
+    return transform
+
+
+def _resampling_grid(starts, new_sizes, patch_size):
+    # source coordinates of output pixel centres, the same mapping cv2.resize uses
+    scales = new_sizes / patch_size
+    coords = (np.arange(patch_size) + 0.5)[np.newaxis, :] * scales[:, np.newaxis] - 0.5
+    coords = np.clip(coords, 0, (new_sizes - 1)[:, np.newaxis])
+    return coords + starts[:, np.newaxis]
+
+
+def _bilinear(array, ys, xs):
+    y0, x0 = np.floor(ys).astype(int), np.floor(xs).astype(int)
+    y1 = np.minimum(y0 + 1, array.shape[1] - 1)
+    x1 = np.minimum(x0 + 1, array.shape[2] - 1)
+    wy = (ys - y0)[:, :, np.newaxis, np.newaxis].astype(np.float32)
+    wx = (xs - x0)[:, np.newaxis, :, np.newaxis].astype(np.float32)
+    samples = np.arange(len(array))[:, np.newaxis, np.newaxis]
+    y0, y1, x0, x1 = y0[:, :, np.newaxis], y1[:, :, np.newaxis], x0[:, np.newaxis, :], x1[:, np.newaxis, :]
+    top = array[samples, y0, x0] * (1 - wx) + array[samples, y0, x1] * wx
+    bottom = array[samples, y1, x0] * (1 - wx) + array[samples, y1, x1] * wx
+    return top * (1 - wy) + bottom * wy
+
+
+def _nearest(array, ys, xs):
+    samples = np.arange(len(array))[:, np.newaxis, np.newaxis]
+    ys = np.round(ys).astype(int)[:, :, np.newaxis]
+    xs = np.round(xs).astype(int)[:, np.newaxis, :]
+    return array[samples, ys, xs]
+
+
+def batch_crop_and_scale(
+    patch_size, scale=0.8, p=0.5, labels="outlines", backend="cv2_per_sample"
+):
+    # "numpy" and "tf" transform all selected samples at once, "cv2_per_sample" resizes them
+    # one by one and is still the fastest on CPU
+    if backend not in ("cv2_per_sample", "numpy", "tf"):
+        raise ValueError(
+            f"unknown backend {backend}, expected 'cv2_per_sample', 'numpy' or 'tf'"
+        )
+
+    def transform(batch):
+        batch_size = len(next(iter(batch.values())))
+        mask = np.random.random(batch_size) < p
+        n_samples = int(mask.sum())
+        if not n_samples:
+            return
+        scale_coefs = np.random.random(n_samples) * (1 - scale) + scale
+        new_sizes = (scale_coefs * patch_size).astype(int)
+        ys = (np.random.random(n_samples) * (patch_size - new_sizes)).astype(int)
+        xs = (np.random.random(n_samples) * (patch_size - new_sizes)).astype(int)
+        if backend == "cv2_per_sample":
+            # one multi-channel resize per selected sample, written back into its batch slot
+            for feature in batch:
+                if len(batch[feature].shape) != 4:
+                    continue
+                interpolation = cv2.INTER_NEAREST_EXACT if feature == labels else cv2.INTER_LINEAR
+                for sample_idx, y, x, new_size in zip(np.flatnonzero(mask), ys, xs, new_sizes):
+                    crop = batch[feature][sample_idx, y:y + new_size, x:x + new_size]
+                    batch[feature][sample_idx] = resize(crop, (patch_size, patch_size), interpolation)
+            return
+        if backend == "tf":
+            boxes = np.stack([ys, xs, ys + new_sizes - 1, xs + new_sizes - 1], axis=-1) / (patch_size - 1)
+            box_indices = np.arange(n_samples)
+        else:
+            grid_y = _resampling_grid(ys, new_sizes, patch_size)
+            grid_x = _resampling_grid(xs, new_sizes, patch_size)
+        for feature in batch:
+            if len(batch[feature].shape) != 4:
+                continue
+            crops = batch[feature][mask]
+            method = "nearest" if feature == labels else "bilinear"
+            if backend == "tf":
+                transformed = tf.image.crop_and_resize(
+                    crops, boxes, box_indices, (patch_size, patch_size), method=method
+                ).numpy()
+            elif method == "nearest":
+                transformed = _nearest(crops, grid_y, grid_x)
+            else:
+                transformed = _bilinear(crops, grid_y, grid_x)
+            batch[feature][mask] = transformed
+    return transform
+
+
+def apply_batch_transformations(batch, transformations):
+    if not transformations:
+        return
+    for transformation in transformations:
+        transformation(batch)
@@ -1,4 +1,89 @@
 import tensorflow as tf
+import numpy as np
+import contextlib
+
+
+def fold_batch_norm(conv, bn):
+    # a Conv2D with the inference-time BatchNormalization folded into its kernel and bias
+    kernel = conv.kernel.numpy().astype(np.float64)
+    bias = conv.bias.numpy().astype(np.float64) if conv.use_bias else 0
+    gamma = bn.gamma.numpy() if bn.scale else 1
+    beta = bn.beta.numpy() if bn.center else 0
+    scale = gamma / np.sqrt(bn.moving_variance.numpy().astype(np.float64) + bn.epsilon)
+    config = conv.get_config()
+    config["use_bias"] = True
+    folded = tf.keras.layers.Conv2D.from_config(config)
+    # variables get the names of the original ones, which .h5 weight files rely on
+    scope = conv.kernel.name.rpartition("/")[0]
+    with tf.name_scope(scope + "/" if scope else ""):
+        folded.build((None, None, None, kernel.shape[2]))
+    folded.set_weights([kernel * scale, (bias - bn.moving_mean.numpy()) * scale + beta])
+    return folded
+
+
+class PointwiseConv2D(tf.keras.layers.Dense):
+    # a Dense over the last axis of feature maps run as a 1x1 convolution. The weights are
+    # those of Dense, so weights saved with Dense layers load unchanged
+    def call(self, x):
+        kernel = tf.reshape(self.kernel, (1, 1) + tuple(self.kernel.shape))
+        y = tf.nn.conv2d(x, tf.cast(kernel, x.dtype), strides=1, padding="VALID")
+        if self.use_bias:
+            y = tf.nn.bias_add(y, tf.cast(self.bias, y.dtype))
+        if self.activation is not None:
+            y = self.activation(y)
+        return y
+
+
+def Pointwise(units, pointwise_conv=False, **kwargs):
+    if pointwise_conv:
+        return PointwiseConv2D(units, **kwargs)
+    return tf.keras.layers.Dense(units, **kwargs)
+
+
+@contextlib.contextmanager
+def frozen_statistics(layer):
+    # with momentum 1 BatchNormalization still normalizes with batch statistics in training,
+    # but leaves its moving averages as they are
+    batch_norms = [_ for _ in layer.submodules if isinstance(_, tf.keras.layers.BatchNormalization)]
+    momentums = [batch_norm.momentum for batch_norm in batch_norms]
+    for batch_norm in batch_norms:
+        batch_norm.momentum = 1.0
+    try:
+        yield
+    finally:
+        for batch_norm, momentum in zip(batch_norms, momentums):
+            batch_norm.momentum = momentum
+
+
+class Recompute(tf.keras.layers.Layer):
+    # gradient checkpointing: in training only the input of the wrapped layer is kept for
+    # backprop, its intermediate activations are recomputed in the backward pass
+    def __init__(self, layer):
+        super(Recompute, self).__init__()
+        self.layer = layer
+        for sublayer in [layer] + list(layer.submodules):
+            if isinstance(sublayer, tf.keras.layers.Dropout) and sublayer.rate > 0:
+                raise ValueError("Recompute does not support dropout, the recomputed masks would differ")
+
+    def call(self, x, training=None):
+        if not training:
+            return self.layer(x, training=training)
+
+        @tf.custom_gradient
+        def forward(x):
+            y = self.layer(x, training=True)
+
+            def grad(dy, variables=None):
+                variables = list(variables or [])
+                with tf.GradientTape() as tape:
+                    tape.watch(x)
+                    # the moving averages were already updated by the forward pass
+                    with frozen_statistics(self.layer):
+                        y = self.layer(x, training=True)
+                gradients = tape.gradient(y, [x] + variables, output_gradients=dy)
+                return gradients[0], gradients[1:]
+            return y, grad
+        return forward(x)
 
 
 class Residual(tf.keras.layers.Layer):
@@ -13,11 +98,11 @@ class Residual(tf.keras.layers.Layer):
 
 
 class ResidualWithProjection(tf.keras.layers.Layer):
-    def __init__(self, layer, projected_size):
+    def __init__(self, layer, projected_size, pointwise_conv=False):
         super(ResidualWithProjection, self).__init__()
         self.layer = layer
         self.projected_size = projected_size
-        self.projection = tf.keras.layers.Dense(projected_size, use_bias=False)
+        self.projection = Pointwise(projected_size, pointwise_conv, use_bias=False)
     
     def call(self, x):
         x1 = self.layer(x)
@@ -45,9 +130,16 @@ class ConvBatchNormAct(tf.keras.layers.Layer):
         if spatial_dropout:
             self.dropout = tf.keras.layers.SpatialDropout2D(spatial_dropout)
 
+    def folded_layers(self):
+        # the attributes utils.deeplearning.fold_batch_norms replaces, built without changing the block
+        if self.bn is None:
+            return {}
+        return {"conv": fold_batch_norm(self.conv, self.bn), "bn": None}
+
     def call(self, x):
         y = self.conv(x)
-        y = self.bn(y)
+        if self.bn is not None:
+            y = self.bn(y)
         y = self.act(y)
         if self.spatial_dropout:
             y = self.dropout(y)
@@ -82,26 +174,46 @@ class ConvBatchNormAct_x2(tf.keras.layers.Layer):
         if spatial_dropout:
             self.dropout = tf.keras.layers.SpatialDropout2D(spatial_dropout)
 
+    def folded_layers(self):
+        if self.bn1 is None:
+            return {}
+        return {
+            "conv1": fold_batch_norm(self.conv1, self.bn1),
+            "conv2": fold_batch_norm(self.conv2, self.bn2),
+            "bn1": None,
+            "bn2": None,
+        }
+
     def call(self, x):
         y = self.conv1(x)
-        y = self.bn1(y)
+        if self.bn1 is not None:
+            y = self.bn1(y)
         y = self.act1(y)
         y = self.conv2(y)
-        y = self.bn2(y)
+        if self.bn2 is not None:
+            y = self.bn2(y)
         y = self.act2(y)
         if self.spatial_dropout:
             y = self.dropout(y)
         return y
 
 
+def upsample_nearest(x, size):
+    # same as UpSampling2D, but the gradient is a reduce_sum instead of ResizeNearestNeighborGrad,
+    # which has no XLA kernel
+    batch_size, height, width, depth = tf.unstack(tf.shape(x))
+    y = tf.broadcast_to(x[:, :, tf.newaxis, :, tf.newaxis, :], (batch_size, height, size, width, size, depth))
+    y = tf.reshape(y, (batch_size, height * size, width * size, depth))
+    y.set_shape([x.shape[0]] + [None if _ is None else _ * size for _ in x.shape[1:3]] + [x.shape[3]])
+    return y
+
+
 class UpConv(tf.keras.layers.Layer):
     def __init__(
         self, n_filters, kernel_size=2, dilation_rate=1, use_bias=False, padding="same"
     ):
         super(UpConv, self).__init__()
-        self.upsampling = tf.keras.layers.UpSampling2D(
-            size=(kernel_size, kernel_size)
-        )
+        self.size = kernel_size
         self.conv = tf.keras.layers.Conv2D(
             n_filters, 
             kernel_size, 
@@ -111,8 +223,14 @@ class UpConv(tf.keras.layers.Layer):
         )
         self.bn = tf.keras.layers.BatchNormalization()
 
+    def folded_layers(self):
+        if self.bn is None:
+            return {}
+        return {"conv": fold_batch_norm(self.conv, self.bn), "bn": None}
+
     def call(self, x):
-        y = self.upsampling(x)
+        y = upsample_nearest(x, self.size)
         y = self.conv(y)
-        y = self.bn(y)
+        if self.bn is not None:
+            y = self.bn(y)
         return y
@@ -10,10 +10,32 @@ class FocalLoss(tf.keras.losses.Loss):
         self.alphas = alphas
 
     def call(self, y_true, y_pred):
+        # clipping and the reduction run in float32, epsilon underflows in float16
+        y_pred = tf.cast(y_pred, tf.float32)
+        y_true = tf.cast(y_true, tf.float32)
         epsilon = tf.keras.backend.epsilon()
         y_pred = tf.keras.backend.clip(y_pred, epsilon, 1 - epsilon)
         ce = y_true * tf.math.log(y_pred)
         loss = -tf.math.pow(1 - y_pred, self.gamma) * ce
         if self.alphas is not None:
             loss = self.alphas * loss
-        return tf.math.reduce_mean(tf.math.reduce_sum(loss, axis=-1))
+        # one value per sample, so the Keras reduction can apply sample weights
+        loss = tf.math.reduce_sum(loss, axis=-1)
+        return tf.math.reduce_mean(loss, axis=list(range(1, len(loss.shape))))
+
+
+class SparseFocalLoss(FocalLoss):
+    # y_true holds class indices, the probability of the true class is gathered instead of
+    # expanding the labels to one-hot
+    def call(self, y_true, y_pred):
+        y_pred = tf.cast(y_pred, tf.float32)
+        y_true = tf.cast(y_true, tf.int32)
+        if len(y_true.shape) == len(y_pred.shape):
+            y_true = tf.squeeze(y_true, axis=-1)
+        epsilon = tf.keras.backend.epsilon()
+        y_pred = tf.keras.backend.clip(y_pred, epsilon, 1 - epsilon)
+        y_pred = tf.gather(y_pred, y_true, axis=-1, batch_dims=len(y_true.shape))
+        loss = -tf.math.pow(1 - y_pred, self.gamma) * tf.math.log(y_pred)
+        if self.alphas is not None:
+            loss = tf.gather(tf.cast(self.alphas, y_pred.dtype), y_true) * loss
+        return tf.math.reduce_mean(loss, axis=list(range(1, len(loss.shape))))
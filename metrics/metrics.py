@@ -10,7 +10,7 @@ class IoU(tf.keras.metrics.Metric):
 
     def update_state(self, y_true, y_pred, sample_weight=None):
         y_pred = tf.argmax(y_pred, axis=-1)
-        y_true = tf.argmax(y_true, axis=-1)
+        y_true = self.true_classes(y_true)
 
         y_pred = tf.cast(y_pred == self.class_id, self.dtype)
         y_true = tf.cast(y_true == self.class_id, self.dtype)
@@ -30,9 +30,23 @@ class IoU(tf.keras.metrics.Metric):
         self.iou.assign_add(tf.reduce_sum(values))
         self.count.assign_add(tf.cast(tf.shape(y_true)[0], tf.float32))
 
+    def true_classes(self, y_true):
+        return tf.argmax(y_true, axis=-1)
+
     def result(self):
         return self.iou / self.count
 
     def reset_state(self):
         self.iou.assign(0.)
         self.count.assign(0.)
+
+
+class SparseIoU(IoU):
+    def __init__(self, class_id=0, name="sparse_iou", **kwargs):
+        super(SparseIoU, self).__init__(class_id=class_id, name=name, **kwargs)
+
+    def true_classes(self, y_true):
+        # y_true holds class indices, with or without a trailing class axis
+        if len(y_true.shape) == 4:
+            y_true = tf.squeeze(y_true, axis=-1)
+        return tf.cast(y_true, tf.int64)
@@ -1,2 +1,3 @@
+from models.mapping.precision import *
 from models.mapping.resunet import *
 from models.mapping.deeplab import *
@@ -4,6 +4,7 @@ Note that original DeepLabV3+ uses ResNet-101 or Xception as encoders, not ResNe
 """
 import tensorflow as tf
 import layers.general
+import models.mapping.precision
 
 
 def DilatedSpatialPyramidPooling(dspp_input, dropout=0):
@@ -26,9 +27,14 @@ def DilatedSpatialPyramidPooling(dspp_input, dropout=0):
 
 
 def DeepLabMini(
-    input_shape, n_outputs, last_activation="softmax", dropout=0,
+    input_shape, n_outputs, last_activation="softmax", dropout=0, dtype_policy=None,
     name="DeepLabMini", **kwargs
 ):
+    with models.mapping.precision.policy_scope(dtype_policy):
+        return _DeepLabMini(input_shape, n_outputs, last_activation, dropout, name, **kwargs)
+
+
+def _DeepLabMini(input_shape, n_outputs, last_activation, dropout, name, **kwargs):
     inputs = tf.keras.layers.Input(input_shape, name="features")
     dims = inputs.shape
 
@@ -53,7 +59,8 @@ def DeepLabMini(
         interpolation="bilinear",
     )(x)
 
-    outputs = tf.keras.layers.Conv2D(n_outputs, 1, activation=last_activation)(x)
+    # the last layer and its activation stay float32 under mixed precision
+    outputs = tf.keras.layers.Conv2D(n_outputs, 1, activation=last_activation, dtype="float32")(x)
     
     model = tf.keras.models.Model(inputs=inputs, outputs=outputs, name=name, **kwargs)
     return model
@@ -0,0 +1,24 @@
+import tensorflow as tf
+import contextlib
+
+
+@contextlib.contextmanager
+def policy_scope(dtype_policy=None):
+    # layers created inside the scope take the policy, e.g. "mixed_float16" or "mixed_bfloat16",
+    # the global policy is restored afterwards
+    if dtype_policy is None:
+        yield
+        return
+    previous_policy = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy(dtype_policy)
+    try:
+        yield
+    finally:
+        tf.keras.mixed_precision.set_global_policy(previous_policy)
+
+
+def loss_scale_optimizer(optimizer, model):
+    # Model.compile does this on its own, custom training loops have to wrap the optimizer
+    if model.dtype_policy.name == "mixed_float16":
+        return tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return optimizer
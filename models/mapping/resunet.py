@@ -1,28 +1,46 @@
 import tensorflow as tf
 import layers.general
+import models.mapping.precision
+
+
+def _checkpointed(block, step, recompute):
+    # recompute is either a bool for all steps or the indices of the recomputed steps
+    if recompute is True or (recompute and step in recompute):
+        return layers.general.Recompute(block)
+    return block
 
 
 def ResUNetEncoder(
-    input_shape, n_steps=4, start_n_filters=64, dropout=0, name="ResUNetEncoder", **kwargs
+    input_shape, n_steps=4, start_n_filters=64, dropout=0, dtype_policy=None, pointwise_conv=False,
+    recompute=False, name="ResUNetEncoder", **kwargs
 ):
+    with models.mapping.precision.policy_scope(dtype_policy):
+        return _ResUNetEncoder(
+            input_shape, n_steps, start_n_filters, dropout, pointwise_conv, recompute, name, **kwargs
+        )
+
+
+def _ResUNetEncoder(input_shape, n_steps, start_n_filters, dropout, pointwise_conv, recompute, name, **kwargs):
     inputs = tf.keras.layers.Input(input_shape)
 
     outputs = []
     x = inputs
     n_filters = start_n_filters
-    for _ in range(n_steps):
-        x = layers.general.ResidualWithProjection(
+    for step in range(n_steps):
+        x = _checkpointed(layers.general.ResidualWithProjection(
             layers.general.ConvBatchNormAct_x2(n_filters, spatial_dropout=dropout), 
-            n_filters
-        )(x)
+            n_filters,
+            pointwise_conv,
+        ), step, recompute)(x)
         outputs.append(x)
         x = tf.keras.layers.MaxPooling2D(pool_size=(2, 2))(x)
         n_filters *= 2
 
-    last_step = layers.general.ResidualWithProjection(
+    last_step = _checkpointed(layers.general.ResidualWithProjection(
         layers.general.ConvBatchNormAct_x2(n_filters, spatial_dropout=dropout), 
-        n_filters
-    )(x)
+        n_filters,
+        pointwise_conv,
+    ), n_steps, recompute)(x)
     outputs.append(last_step)
 
     model = tf.keras.models.Model(inputs=inputs, outputs=outputs, name=name, **kwargs)
@@ -30,8 +48,18 @@ def ResUNetEncoder(
 
 
 def ResUNetDecoder(
-    input_shape, n_outputs, n_steps=4, last_activation="softmax", dropout=0, 
-    name="ResUNetDecoder", **kwargs
+    input_shape, n_outputs, n_steps=4, last_activation="softmax", dropout=0, dtype_policy=None,
+    pointwise_conv=False, recompute=False, name="ResUNetDecoder", **kwargs
+):
+    with models.mapping.precision.policy_scope(dtype_policy):
+        return _ResUNetDecoder(
+            input_shape, n_outputs, n_steps, last_activation, dropout, pointwise_conv, recompute, name,
+            **kwargs
+        )
+
+
+def _ResUNetDecoder(
+    input_shape, n_outputs, n_steps, last_activation, dropout, pointwise_conv, recompute, name, **kwargs
 ):
     encoded_height, encoded_width, encoded_depth = input_shape
     inputs = []
@@ -42,20 +70,24 @@ def ResUNetDecoder(
     x = input1
     n_filters = encoded_depth // 2
     input_height, input_width = encoded_height * 2, encoded_width * 2
-    for _ in range(n_steps):
+    for step in range(n_steps):
         upsampling = layers.general.UpConv(n_filters)(x)
         input_i = tf.keras.layers.Input((input_height, input_width, n_filters))
         inputs.append(input_i)
         concat = tf.keras.layers.Concatenate()([upsampling, input_i])
-        x = layers.general.ResidualWithProjection(
+        x = _checkpointed(layers.general.ResidualWithProjection(
             layers.general.ConvBatchNormAct_x2(n_filters, spatial_dropout=dropout), 
-            n_filters
-        )(concat)
+            n_filters,
+            pointwise_conv,
+        ), step, recompute)(concat)
         n_filters //= 2
         input_height *= 2
         input_width *= 2
     
-    outputs = tf.keras.layers.Dense(n_outputs, activation=last_activation)(x)
+    # the last layer and its activation stay float32 under mixed precision
+    outputs = layers.general.Pointwise(
+        n_outputs, pointwise_conv, activation=last_activation, dtype="float32"
+    )(x)
 
     model = tf.keras.models.Model(inputs=inputs, outputs=outputs, name=name, **kwargs)
     return model
@@ -63,30 +95,35 @@ def ResUNetDecoder(
 
 def ResUNet(
     input_shape, n_outputs, n_steps=4, start_n_filters=64, last_activation="softmax", 
-    dropout=0, name="ResUNet", **kwargs
+    dropout=0, dtype_policy=None, pointwise_conv=False, recompute=False, name="ResUNet", **kwargs
 ):
-    inputs = tf.keras.layers.Input(input_shape, name="features")
-    encoded = ResUNetEncoder(
-        input_shape, 
-        n_steps=n_steps, 
-        start_n_filters=start_n_filters,
-        dropout=dropout, 
-    )(inputs)
-    decoded = ResUNetDecoder(
-        encoded[-1].shape[1:],
-        n_outputs,
-        n_steps=n_steps, 
-        last_activation=last_activation,
-        dropout=dropout,
-    )(encoded[::-1])
+    with models.mapping.precision.policy_scope(dtype_policy):
+        inputs = tf.keras.layers.Input(input_shape, name="features")
+        encoded = ResUNetEncoder(
+            input_shape, 
+            n_steps=n_steps, 
+            start_n_filters=start_n_filters,
+            dropout=dropout, 
+            pointwise_conv=pointwise_conv,
+            recompute=recompute,
+        )(inputs)
+        decoded = ResUNetDecoder(
+            encoded[-1].shape[1:],
+            n_outputs,
+            n_steps=n_steps, 
+            last_activation=last_activation,
+            dropout=dropout,
+            pointwise_conv=pointwise_conv,
+            recompute=recompute,
+        )(encoded[::-1])
 
-    model = tf.keras.models.Model(inputs=inputs, outputs=decoded, name=name, **kwargs)
+        model = tf.keras.models.Model(inputs=inputs, outputs=decoded, name=name, **kwargs)
     return model
 
 
 def ResUNetMini(
-    input_shape, n_outputs, last_activation="softmax", dropout=0,
-    name="ResUNetMini", **kwargs
+    input_shape, n_outputs, last_activation="softmax", dropout=0, dtype_policy=None,
+    pointwise_conv=False, recompute=False, name="ResUNetMini", **kwargs
 ):
     return ResUNet(
         input_shape,
@@ -95,6 +132,9 @@ def ResUNetMini(
         start_n_filters=32,
         last_activation=last_activation,
         dropout=dropout,
+        dtype_policy=dtype_policy,
+        pointwise_conv=pointwise_conv,
+        recompute=recompute,
         name=name,
         **kwargs
     )
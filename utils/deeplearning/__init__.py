@@ -1 +1,3 @@
 from utils.deeplearning.utils import *
+from utils.deeplearning.inference import *
+from utils.deeplearning.trainer import *
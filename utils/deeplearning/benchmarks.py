@@ -0,0 +1,124 @@
+import tensorflow as tf
+import layers.general
+import models.mapping
+import numpy as np
+import multiprocessing
+import argparse
+import resource
+import time
+
+
+def resunet_projections(patch_size=384, input_depth=10, n_steps=4, start_n_filters=64, n_outputs=2):
+    # (name, size, input depth, output depth) of every Dense applied to feature maps in ResUNet
+    blocks = []
+    depth, n_filters, size = input_depth, start_n_filters, patch_size
+    for step in range(n_steps + 1):
+        blocks.append((f"encoder_{step}", size, depth, n_filters))
+        depth, n_filters, size = n_filters, n_filters * 2, size // 2
+    n_filters, size = n_filters // 4, size * 4
+    for step in range(n_steps):
+        blocks.append((f"decoder_{step}", size, 2 * n_filters, n_filters))
+        n_filters, size = n_filters // 2, size * 2
+    blocks.append(("head", size // 2, 2 * n_filters, n_outputs))
+    return blocks
+
+
+def time_function(function, x, n_runs):
+    function(x)
+    start_time = time.perf_counter()
+    for _ in range(n_runs):
+        y = function(x)
+    # the last result is fetched so that asynchronous execution is included
+    np.asarray(y)
+    return (time.perf_counter() - start_time) / n_runs
+
+
+def benchmark_pointwise(patch_size=384, batch_size=1, input_depth=10, n_runs=10, training=False):
+    print(f"{'block':<10}  {'shape':<22}  {'dense [ms]':>10}  {'conv [ms]':>10}  {'speedup':>7}  {'max diff':>8}")
+    for name, size, depth, units in resunet_projections(patch_size, input_depth):
+        x = tf.random.normal((batch_size, size, size, depth))
+        dense = tf.keras.layers.Dense(units)
+        conv = layers.general.PointwiseConv2D(units)
+        dense.build(x.shape)
+        conv.build(x.shape)
+        conv.set_weights(dense.get_weights())
+        timings = []
+        for layer in (dense, conv):
+            if training:
+                def function(x, layer=layer):
+                    with tf.GradientTape() as tape:
+                        tape.watch(x)
+                        y = tf.reduce_sum(layer(x))
+                    return tape.gradient(y, [x] + layer.trainable_weights)[0]
+            else:
+                function = layer
+            timings.append(time_function(tf.function(function), x, n_runs))
+        difference = np.max(np.abs(dense(x).numpy() - conv(x).numpy()))
+        shape = f"{size}x{size}x{depth} -> {units}"
+        print(
+            f"{name:<10}  {shape:<22}  {1000 * timings[0]:>10.2f}  {1000 * timings[1]:>10.2f}  "
+            f"{timings[0] / timings[1]:>7.2f}  {difference:>8.1e}"
+        )
+
+
+def peak_memory():
+    if tf.config.list_physical_devices("GPU"):
+        return tf.config.experimental.get_memory_info("GPU:0")["peak"]
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure_train_step(patch_size, batch_size, input_depth, n_steps, recompute, n_runs, n_outputs=2):
+    model = models.mapping.ResUNet((patch_size, patch_size, input_depth), n_outputs, n_steps, recompute=recompute)
+    optimizer = tf.keras.optimizers.SGD(1e-3)
+    loss_function = tf.keras.losses.CategoricalCrossentropy()
+    x = tf.random.normal((batch_size, patch_size, patch_size, input_depth))
+    y = tf.one_hot(tf.random.uniform((batch_size, patch_size, patch_size), maxval=n_outputs, dtype=tf.int32), n_outputs)
+
+    @tf.function
+    def train_step(x):
+        with tf.GradientTape() as tape:
+            loss = loss_function(y, model(x, training=True))
+        optimizer.apply_gradients(zip(tape.gradient(loss, model.trainable_weights), model.trainable_weights))
+        return loss
+
+    # peak memory before the first step covers the weights and whatever tensorflow keeps around,
+    # so the difference is the memory the train step itself needs
+    if tf.config.list_physical_devices("GPU"):
+        tf.config.experimental.reset_memory_stats("GPU:0")
+    baseline = peak_memory()
+    step_time = time_function(train_step, x, n_runs)
+    return peak_memory() - baseline, step_time
+
+
+def benchmark_recompute(patch_size=384, batch_size=1, input_depth=10, n_runs=10, n_steps_range=(3, 4, 5)):
+    # every configuration runs in a fresh process, peak memory can not be reset otherwise on the cpu
+    context = multiprocessing.get_context("spawn")
+    print(f"{'n_steps':>7}  {'recompute':>9}  {'peak memory [MB]':>16}  {'step [ms]':>10}")
+    for n_steps in n_steps_range:
+        for recompute in (False, True):
+            with context.Pool(1) as pool:
+                memory, step_time = pool.apply(
+                    measure_train_step, (patch_size, batch_size, input_depth, n_steps, recompute, n_runs)
+                )
+            print(f"{n_steps:>7}  {str(recompute):>9}  {memory / 2**20:>16.1f}  {1000 * step_time:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=["pointwise", "recompute"], help="Benchmark to run")
+    parser.add_argument("--patch_size", default=384, type=int, help="Patch size of the benchmarked model")
+    parser.add_argument("--batch_size", default=1, type=int, help="Batch size")
+    parser.add_argument("--input_depth", default=10, type=int, help="Number of input features")
+    parser.add_argument("--n_runs", default=10, type=int, help="Number of timed runs per block or train step")
+    parser.add_argument("--training", action="store_true", help="Time forward and backward passes")
+    args = parser.parse_args()
+
+    if args.benchmark == "pointwise":
+        benchmark_pointwise(args.patch_size, args.batch_size, args.input_depth, args.n_runs, args.training)
+    elif args.benchmark == "recompute":
+        benchmark_recompute(args.patch_size, args.batch_size, args.input_depth, args.n_runs)
+
+
+if __name__ == "__main__":
+    main()
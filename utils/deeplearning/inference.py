@@ -0,0 +1,304 @@
+import tensorflow as tf
+import numpy as np
+import utils.misc
+import rasterio
+import rasterio.windows
+import functools
+import time
+import os
+
+
+def gaussian_kernel(size, mu=0, sigma=1):
+    x, y = np.meshgrid(np.linspace(-1, 1, size), np.linspace(-1, 1, size))
+    distance = np.sqrt(x**2 + y**2)
+    kernel = np.exp(-(distance - mu)**2 / 2/ sigma**2) / np.sqrt(2 / np.pi) / sigma
+    return kernel
+
+
+@functools.lru_cache(maxsize=8)
+def gaussian_weights(patch_size, dtype=np.float32):
+    weights = gaussian_kernel(patch_size).astype(dtype)[..., np.newaxis]
+    weights.setflags(write=False)
+    return weights
+
+
+def fold_batch_norms(model, sample=None, atol=1e-4, verbose=0):
+    # folds BatchNormalization into the preceding Conv2D of every layers.general block and
+    # checks that predictions do not change. The blocks are changed in place only if the check
+    # passes. The returned model is a new object over them so that no function traced for the
+    # old one is reused. Plain Keras Conv2D and BatchNormalization layers, e.g. the ResNet50
+    # backbone of DeepLabMini, are left as they are
+    if sample is None:
+        sample = np.random.random((1, ) + tuple(model.input_shape[1:])).astype(np.float32)
+    expected = model(sample, training=False).numpy()
+    # every folded layer is built before any block is changed
+    replacements = [
+        (module, module.folded_layers()) for module in model.submodules if hasattr(module, "folded_layers")
+    ]
+    replacements = [(module, layers) for module, layers in replacements if layers]
+    originals = [
+        (module, {name: getattr(module, name) for name in layers}) for module, layers in replacements
+    ]
+    # the check swaps the layers in past Keras tracking, so a failed check leaves the blocks
+    # and the order of their weights exactly as they were
+    for module, layers in replacements:
+        for name, layer in layers.items():
+            object.__setattr__(module, name, layer)
+    folded_model = tf.keras.models.Model(inputs=model.inputs, outputs=model.outputs, name=model.name)
+    difference = np.max(np.abs(folded_model(sample, training=False).numpy() - expected))
+    for module, layers in originals:
+        for name, layer in layers.items():
+            object.__setattr__(module, name, layer)
+    if verbose > 0:
+        print(f"fold_batch_norms: {len(replacements)} blocks folded, max difference {difference:.2e}")
+    if not difference <= atol:
+        raise ValueError(f"Folded model differs from the original by {difference}, more than {atol}")
+    for module, layers in replacements:
+        for name, layer in layers.items():
+            setattr(module, name, layer)
+    return folded_model
+
+
+@tf.function
+def predict_batch(model, batch):
+    return model(batch, training=False)
+
+
+def window_offsets(height, width, patch_size, stride):
+    n_rows = max((height - patch_size) // stride + 1, 0)
+    n_cols = max((width - patch_size) // stride + 1, 0)
+    rows, cols = np.meshgrid(np.arange(n_rows), np.arange(n_cols), indexing="ij")
+    return rows.ravel(), cols.ravel()
+
+
+def strided_windows(features, patch_size, stride):
+    height, width, depth = features.shape
+    n_rows = max((height - patch_size) // stride + 1, 0)
+    n_cols = max((width - patch_size) // stride + 1, 0)
+    row_stride, col_stride, depth_stride = features.strides
+    return np.lib.stride_tricks.as_strided(
+        features,
+        shape=(n_rows, n_cols, patch_size, patch_size, depth),
+        strides=(stride * row_stride, stride * col_stride, row_stride, col_stride, depth_stride),
+        writeable=False,
+    )
+
+
+def scatter_add(blocks, patches, rows, cols):
+    # blocks are the accumulator viewed as (rows, stride, cols, stride, depth); the window
+    # at (row, col) covers the blocks row:row + n_sub, col:col + n_sub. Windows in one call
+    # are distinct, so for a fixed sub-block offset every target block is hit at most once
+    # and a buffered fancy-index add is exact
+    stride = blocks.shape[1]
+    n_sub = patches.shape[1] // stride
+    for sub_row in range(n_sub):
+        for sub_col in range(n_sub):
+            blocks[rows + sub_row, :, cols + sub_col, :, :] += patches[
+                :,
+                sub_row * stride:(sub_row + 1) * stride,
+                sub_col * stride:(sub_col + 1) * stride,
+                :
+            ]
+
+
+def accumulate_weights(blocks, weights, n_rows, n_cols):
+    # all windows share the same weight map, so counts reduce to shifted broadcast adds
+    stride = blocks.shape[1]
+    n_sub = weights.shape[0] // stride
+    for sub_row in range(n_sub):
+        for sub_col in range(n_sub):
+            blocks[sub_row:sub_row + n_rows, :, sub_col:sub_col + n_cols, :, :] += weights[
+                np.newaxis,
+                sub_row * stride:(sub_row + 1) * stride,
+                np.newaxis,
+                sub_col * stride:(sub_col + 1) * stride,
+                :
+            ]
+
+
+def predict_windows(model, windows, rows, cols, batch, weights, blocks):
+    batch_size = len(batch)
+    for batch_start in range(0, len(rows), batch_size):
+        batch_rows = rows[batch_start:batch_start + batch_size]
+        batch_cols = cols[batch_start:batch_start + batch_size]
+        n_valid = len(batch_rows)
+        for patch_idx, (row, col) in enumerate(zip(batch_rows, batch_cols)):
+            batch[patch_idx] = windows[row, col]
+        # the tail batch keeps stale patches in its unused slots so the traced shape never changes
+        patch_probs = predict_batch(model, batch)
+        patch_probs = np.multiply(np.asarray(patch_probs)[:n_valid], weights, dtype=blocks.dtype)
+        scatter_add(blocks, patch_probs, batch_rows, batch_cols)
+
+
+def apply(
+    features, model, patch_size=384, batch_size=4, n_outputs=2, stride=None,
+    mins=None, maxs=None, dtype=np.float32, verbose=0
+):
+    # with mins and maxs, features is the raw unpadded stack. It is normalized row by row
+    # straight into a stack padded with 0 like the .hdf5 subsets and left untouched, the
+    # output covers the unpadded area. Without them, features should already be normalized
+    # and padded
+    if mins is not None:
+        height, width, depth = features.shape
+        new_height = (height // patch_size + 1) * patch_size
+        new_width = (width // patch_size + 1) * patch_size
+        pad_height = (new_height - height) // 2
+        pad_width = (new_width - width) // 2
+        padded = np.zeros((new_height, new_width, depth), dtype=np.float32)
+        for row in range(height):
+            # a single row of the interior is contiguous, so it is written without a copy
+            utils.misc.normalize(
+                features[row], mins, maxs, out=padded[pad_height + row, pad_width:pad_width + width]
+            )
+        prob = apply(
+            padded, model, patch_size, batch_size, n_outputs, stride, dtype=dtype, verbose=verbose
+        )
+        return prob[pad_height:pad_height + height, pad_width:pad_width + width]
+    if stride is None:
+        stride = patch_size // 2
+    if patch_size % stride != 0:
+        raise ValueError(f"patch_size {patch_size} is not divisible by stride {stride}")
+    height, width, depth = features.shape
+    n_sub = patch_size // stride
+
+    windows = strided_windows(features, patch_size, stride)
+    n_rows, n_cols = windows.shape[:2]
+    rows, cols = window_offsets(height, width, patch_size, stride)
+    n_patches = len(rows)
+
+    n_block_rows = n_rows + n_sub - 1 if n_patches else 0
+    n_block_cols = n_cols + n_sub - 1 if n_patches else 0
+    weighted_prob = np.zeros((n_block_rows, stride, n_block_cols, stride, n_outputs), dtype=dtype)
+    counts = np.zeros((n_block_rows, stride, n_block_cols, stride, 1), dtype=dtype)
+    weights = gaussian_weights(patch_size, dtype)
+    accumulate_weights(counts, weights, n_rows, n_cols)
+
+    batch = np.zeros((batch_size, patch_size, patch_size, depth), dtype=np.float32)
+    start_time = time.perf_counter()
+    predict_windows(model, windows, rows, cols, batch, weights, weighted_prob)
+    elapsed = time.perf_counter() - start_time
+
+    if verbose > 0 and n_patches:
+        print(f"apply: {n_patches} patches in {elapsed:.2f}s ({n_patches / elapsed:.1f} patches/sec)")
+
+    prob = np.full((height, width, n_outputs), np.nan, dtype=dtype)
+    covered_height, covered_width = n_block_rows * stride, n_block_cols * stride
+    np.divide(
+        weighted_prob.reshape((covered_height, covered_width, n_outputs)),
+        counts.reshape((covered_height, covered_width, 1)),
+        out=prob[:covered_height, :covered_width, :],
+    )
+    return prob
+
+
+def apply_to_raster(
+    input_path, output_path, model, patch_size=384, batch_size=4, n_outputs=2, stride=None,
+    mins=None, maxs=None, output="labels", block_size=256, compress="deflate", dtype=np.float32,
+    verbose=0
+):
+    if stride is None:
+        stride = patch_size // 2
+    if patch_size % stride != 0:
+        raise ValueError(f"patch_size {patch_size} is not divisible by stride {stride}")
+    if output not in ("labels", "probabilities"):
+        raise ValueError(f"Unknown output {output}, expected 'labels' or 'probabilities'")
+    n_sub = patch_size // stride
+
+    with rasterio.open(input_path, "r") as src:
+        depth, height, width = src.count, src.height, src.width
+
+        # the scene is padded the same way the .hdf5 subsets are, padding never leaves memory
+        new_height = (height // patch_size + 1) * patch_size
+        new_width = (width // patch_size + 1) * patch_size
+        pad_height = (new_height - height) // 2
+        pad_width = (new_width - width) // 2
+        n_rows = (new_height - patch_size) // stride + 1
+        n_cols = (new_width - patch_size) // stride + 1
+        n_block_cols = n_cols + n_sub - 1
+
+        meta = src.meta.copy()
+        meta.update({
+            "driver": "GTiff",
+            "tiled": True,
+            "blockxsize": block_size,
+            "blockysize": block_size,
+            "compress": compress,
+        })
+        if output == "labels":
+            meta.update({"dtype": np.uint8, "count": 1, "nodata": 0})
+        else:
+            meta.update({"dtype": np.float32, "count": n_outputs, "nodata": None})
+
+        # a raster left incomplete by an exception is removed
+        try:
+            with rasterio.open(output_path, "w", **meta) as dst:
+                # rolling state: one window row of input and the n_sub block rows it still contributes to
+                band = np.zeros((patch_size, new_width, depth), dtype=np.float32)
+                weighted_prob = np.zeros((n_sub, stride, n_block_cols, stride, n_outputs), dtype=dtype)
+                counts = np.zeros((n_sub, stride, n_block_cols, stride, 1), dtype=dtype)
+                weights = gaussian_weights(patch_size, dtype)
+                batch = np.zeros((batch_size, patch_size, patch_size, depth), dtype=np.float32)
+                rows = np.zeros(n_cols, dtype=int)
+                cols = np.arange(n_cols)
+
+                def read_rows(row_start, row_stop, band_start):
+                    band[band_start:band_start + row_stop - row_start] = 0
+                    src_start = max(row_start - pad_height, 0)
+                    src_stop = min(row_stop - pad_height, height)
+                    if src_start >= src_stop:
+                        return
+                    window = rasterio.windows.Window(0, src_start, width, src_stop - src_start)
+                    data = np.moveaxis(src.read(window=window, out_dtype=np.float32), 0, -1)
+                    if mins is not None:
+                        # normalized before padding, so padding stays 0 like in the .hdf5 subsets
+                        data = utils.misc.normalize(data, mins, maxs)
+                    band_offset = band_start + src_start + pad_height - row_start
+                    band[band_offset:band_offset + len(data), pad_width:pad_width + width] = data
+
+                def write_block_row(block_row):
+                    row_start = block_row * stride - pad_height
+                    dst_start, dst_stop = max(row_start, 0), min(row_start + stride, height)
+                    if dst_start >= dst_stop:
+                        return
+                    prob = weighted_prob[0].reshape((stride, n_block_cols * stride, n_outputs))
+                    prob = prob / counts[0].reshape((stride, n_block_cols * stride, 1))
+                    prob = prob[dst_start - row_start:dst_stop - row_start, pad_width:pad_width + width]
+                    window = rasterio.windows.Window(0, dst_start, width, dst_stop - dst_start)
+                    if output == "labels":
+                        dst.write(np.argmax(prob, axis=-1).astype(np.uint8), 1, window=window)
+                    else:
+                        dst.write(np.moveaxis(prob.astype(np.float32), -1, 0), window=window)
+
+                def shift_block_rows():
+                    weighted_prob[:-1] = weighted_prob[1:]
+                    weighted_prob[-1] = 0
+                    counts[:-1] = counts[1:]
+                    counts[-1] = 0
+
+                start_time = time.perf_counter()
+                for row in range(n_rows):
+                    row_start = row * stride
+                    if row == 0:
+                        read_rows(0, patch_size, 0)
+                    else:
+                        band[:patch_size - stride] = band[stride:]
+                        read_rows(row_start + patch_size - stride, row_start + patch_size, patch_size - stride)
+                    windows = strided_windows(band, patch_size, stride)
+                    predict_windows(model, windows, rows, cols, batch, weights, weighted_prob)
+                    accumulate_weights(counts, weights, 1, n_cols)
+
+                    # the top block row gets no more contributions once its window row is done
+                    write_block_row(row)
+                    shift_block_rows()
+                for block_row in range(n_rows, n_rows + n_sub - 1):
+                    write_block_row(block_row)
+                    shift_block_rows()
+                elapsed = time.perf_counter() - start_time
+        except BaseException:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+
+    if verbose > 0:
+        n_patches = n_rows * n_cols
+        print(f"apply_to_raster: {n_patches} patches in {elapsed:.2f}s ({n_patches / elapsed:.1f} patches/sec)")
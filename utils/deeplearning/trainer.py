@@ -0,0 +1,168 @@
+import tensorflow as tf
+import dataloaders.dataloaders
+import models.mapping
+import numpy as np
+
+
+class WarmupPlateau(tf.keras.optimizers.schedules.LearningRateSchedule):
+    # linear warmup from start to target like LRWarmup, then target scaled by factor. The
+    # schedule is evaluated in the graph from optimizer.iterations, only factor is changed
+    # from the host, once per plateau
+    def __init__(self, target, warmup_steps, start=0.0, factor=1.0):
+        super(WarmupPlateau, self).__init__()
+        self.target = target
+        self.warmup_steps = warmup_steps
+        self.start = start
+        self.factor = tf.Variable(factor, trainable=False, dtype=tf.float32, name="lr_factor")
+
+    def __call__(self, step):
+        step = tf.cast(step, tf.float32)
+        progress = tf.minimum(step / max(self.warmup_steps, 1), 1.0)
+        return ((self.target - self.start) * progress + self.start) * self.factor
+
+    def get_config(self):
+        return {
+            "target": self.target,
+            "warmup_steps": self.warmup_steps,
+            "start": self.start,
+            "factor": float(self.factor.numpy()),
+        }
+
+
+class ReduceFactorOnPlateau(tf.keras.callbacks.Callback):
+    # ReduceLROnPlateau for WarmupPlateau, which owns the learning rate
+    def __init__(self, schedule, monitor="val_loss", mode="min", factor=0.1, patience=10, min_delta=0, verbose=0):
+        super(ReduceFactorOnPlateau, self).__init__()
+        self.schedule = schedule
+        self.monitor = monitor
+        self.mode = mode
+        self.factor = factor
+        self.patience = patience
+        self.min_delta = min_delta
+        self.verbose = verbose
+
+    def on_train_begin(self, logs=None):
+        self.wait = 0
+        self.best = -np.inf if self.mode == "max" else np.inf
+
+    def on_epoch_end(self, epoch, logs=None):
+        current = (logs or {}).get(self.monitor)
+        if current is None:
+            return
+        if self.mode == "max":
+            improved = current > self.best + self.min_delta
+        else:
+            improved = current < self.best - self.min_delta
+        if improved:
+            self.best = current
+            self.wait = 0
+            return
+        self.wait += 1
+        if self.wait >= self.patience:
+            self.schedule.factor.assign(self.schedule.factor * self.factor)
+            self.wait = 0
+            if self.verbose > 0:
+                print(f"\nReduceFactorOnPlateau callback: set learning rate factor to {self.schedule.factor.numpy()}")
+
+
+class Trainer:
+    # custom training loop as an alternative to model.fit for single-output models. Every call
+    # runs steps_per_call batches in one graph, the forward and backward pass of each batch is
+    # compiled with XLA. Callbacks only get epoch hooks and one batch hook per call
+    def __init__(self, model, loss, optimizer, metrics=None, steps_per_call=1, jit_compile=True):
+        self.model = model
+        self.loss = loss
+        self.optimizer = models.mapping.loss_scale_optimizer(optimizer, model)
+        self.loss_scaling = isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+        self.loss_tracker = tf.keras.metrics.Mean(name="loss")
+        self.metrics = [self.loss_tracker] + list(metrics or [])
+        self.steps_per_call = steps_per_call
+        self.compiled_train_step = tf.function(self.train_step, jit_compile=jit_compile)
+        self.compiled_test_step = tf.function(self.test_step, jit_compile=jit_compile)
+        self.train_function = tf.function(self.run_train_steps)
+        self.test_function = tf.function(self.run_test_steps)
+
+    def compute_loss(self, y, y_pred, sample_weight):
+        loss = self.loss(y, y_pred, sample_weight)
+        if self.model.losses:
+            loss = loss + tf.cast(tf.add_n(self.model.losses), loss.dtype)
+        return loss
+
+    def train_step(self, x, y, sample_weight=None):
+        with tf.GradientTape() as tape:
+            y_pred = self.model(x, training=True)
+            loss = self.compute_loss(y, y_pred, sample_weight)
+            scaled_loss = self.optimizer.get_scaled_loss(loss) if self.loss_scaling else loss
+        gradients = tape.gradient(scaled_loss, self.model.trainable_weights)
+        if self.loss_scaling:
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_weights))
+        return loss, y_pred
+
+    def test_step(self, x, y, sample_weight=None):
+        y_pred = self.model(x, training=False)
+        return self.compute_loss(y, y_pred, sample_weight), y_pred
+
+    def update_metrics(self, loss, y, y_pred, sample_weight):
+        self.loss_tracker.update_state(loss)
+        for metric in self.metrics[1:]:
+            metric.update_state(y, y_pred, sample_weight)
+
+    def run_train_steps(self, iterator, n_steps):
+        # the iterator is read outside of the XLA cluster
+        for _ in tf.range(n_steps):
+            x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(next(iterator))
+            loss, y_pred = self.compiled_train_step(x, y, sample_weight)
+            self.update_metrics(loss, y, y_pred, sample_weight)
+
+    def run_test_steps(self, iterator, n_steps):
+        for _ in tf.range(n_steps):
+            x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(next(iterator))
+            loss, y_pred = self.compiled_test_step(x, y, sample_weight)
+            self.update_metrics(loss, y, y_pred, sample_weight)
+
+    def results(self, prefix=""):
+        return {f"{prefix}{metric.name}": float(metric.result()) for metric in self.metrics}
+
+    def reset_metrics(self):
+        for metric in self.metrics:
+            metric.reset_state()
+
+    def run_epoch(self, sequence, function, callbacks=None):
+        n_batches = len(sequence)
+        iterator = iter(dataloaders.dataloaders.sequence_dataset(sequence))
+        self.reset_metrics()
+        for step in range(0, n_batches, self.steps_per_call):
+            # the tail call gets fewer steps through a tensor, so nothing is traced again
+            n_steps = min(self.steps_per_call, n_batches - step)
+            if callbacks is not None:
+                callbacks.on_train_batch_begin(step)
+            function(iterator, tf.constant(n_steps))
+            if callbacks is not None:
+                callbacks.on_train_batch_end(step + n_steps - 1, self.results())
+        sequence.on_epoch_end()
+
+    def evaluate(self, sequence):
+        self.run_epoch(sequence, self.test_function)
+        return self.results()
+
+    def fit(self, dataloader, epochs=1, validation_data=None, callbacks=None, verbose=1):
+        callbacks = tf.keras.callbacks.CallbackList(
+            callbacks, add_history=True, add_progbar=verbose > 0, model=self.model,
+            verbose=verbose, epochs=epochs, steps=len(dataloader),
+        )
+        self.model.stop_training = False
+        logs = {}
+        callbacks.on_train_begin()
+        for epoch in range(epochs):
+            callbacks.on_epoch_begin(epoch)
+            self.run_epoch(dataloader, self.train_function, callbacks)
+            logs = self.results()
+            if validation_data is not None:
+                self.run_epoch(validation_data, self.test_function)
+                logs.update(self.results("val_"))
+            callbacks.on_epoch_end(epoch, logs)
+            if self.model.stop_training:
+                break
+        callbacks.on_train_end(logs)
+        return self.model.history
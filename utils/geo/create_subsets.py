@@ -0,0 +1,227 @@
+import concurrent.futures
+import rasterio
+import rasterio.windows
+import geopandas
+import numpy as np
+import argparse
+import random
+import pickle
+import h5py
+import os
+
+
+SUBSETS = ("train", "val", "test")
+
+_rasters = {}
+
+
+def split_tiles(region_tiles, fractions=(0.6, 0.2, 0.2), seed=42):
+    subsets = {subset: set() for subset in SUBSETS}
+    random.seed(seed)
+    train_end = fractions[0]
+    val_end = fractions[0] + fractions[1]
+    for region in region_tiles:
+        codenames = list(region_tiles[region]["codename"])
+        random.shuffle(codenames)
+        n_tiles = len(codenames)
+        subsets["train"].update(codenames[:int(train_end * n_tiles)])
+        subsets["val"].update(codenames[int(train_end * n_tiles):int(val_end * n_tiles)])
+        subsets["test"].update(codenames[int(val_end * n_tiles):])
+    return subsets
+
+
+def _open_raster(path):
+    # every worker process keeps its own handles open across tiles
+    if path not in _rasters:
+        _rasters[path] = rasterio.open(path, "r")
+    return _rasters[path]
+
+
+def crop_tile(stack_path, outlines_path, bounds, patch_size, n_classes, mins=None, maxs=None, dtype=np.float32):
+    stack = _open_raster(stack_path)
+    outlines = _open_raster(outlines_path)
+
+    # read rasters cropped to tile
+    xmin, ymin, xmax, ymax = bounds
+    window = rasterio.windows.from_bounds(xmin, ymin, xmax, ymax, transform=stack.transform)
+    stack_cropped = np.moveaxis(stack.read(window=window, out_dtype=dtype), 0, -1)
+    outlines_cropped = outlines.read(1, window=window)
+
+    # normalize and curate features. Raw float features keep invalid pixels and padding as NaN,
+    # which the Normalization plugin maps to 0 like apply and apply_to_raster do
+    fill = 0
+    if mins is not None:
+        stack_cropped = ((stack_cropped - mins) / (maxs - mins)).astype(dtype)
+    elif np.issubdtype(dtype, np.floating):
+        fill = np.nan
+    stack_cropped[~np.isfinite(stack_cropped)] = fill
+
+    # pad features and outlines to fit patch size, padding stripes are background
+    height, width = outlines_cropped.shape
+    new_height = (height // patch_size + 1) * patch_size
+    new_width = (width // patch_size + 1) * patch_size
+    pad_height = (new_height - height) // 2
+    pad_width = (new_width - width) // 2
+    features = np.full((new_height, new_width, stack_cropped.shape[-1]), fill, dtype=dtype)
+    features[pad_height:pad_height + height, pad_width:pad_width + width, :] = stack_cropped
+    labels = np.zeros((new_height, new_width), dtype=np.uint8)
+    labels[pad_height:pad_height + height, pad_width:pad_width + width] = outlines_cropped
+    outlines_onehot = (labels[..., np.newaxis] == np.arange(n_classes)).astype(np.uint8)
+
+    attrs = {
+        "pad_height": pad_height,
+        "pad_width": pad_width,
+        "height": height,
+        "width": width,
+        "xmin": xmin,
+        "ymin": ymin,
+        "xmax": xmax,
+        "ymax": ymax,
+    }
+    return features, outlines_onehot, attrs
+
+
+def _done_path(subset_path):
+    return f"{subset_path}.done"
+
+
+def _check_overwrite(subset_paths, overwrite):
+    # subsets without a log, e.g. built by the notebook, are only replaced when asked to, and
+    # all of them are checked before any is opened
+    for subset_path in subset_paths:
+        if os.path.exists(subset_path) and not os.path.exists(_done_path(subset_path)) and not overwrite:
+            raise FileExistsError(
+                f"{subset_path} exists without {_done_path(subset_path)}, pass overwrite=True to rebuild it"
+            )
+
+
+def _open_subset(subset_path):
+    # without a log the file is not ours to resume, it is rewritten from scratch, since
+    # HDF5 does not free the space of deleted groups
+    if not os.path.exists(_done_path(subset_path)):
+        subset = h5py.File(subset_path, "w")
+        open(_done_path(subset_path), "w").close()
+        return subset, set()
+    with open(_done_path(subset_path), "r") as done_file:
+        done = set(done_file.read().split())
+    # groups that are not in the log were interrupted while being written, logged groups
+    # missing from the file, e.g. after it was moved, are written again
+    subset = h5py.File(subset_path, "a")
+    done &= set(subset.keys())
+    for codename in list(subset.keys()):
+        if codename not in done:
+            del subset[codename]
+    with open(_done_path(subset_path), "w") as done_file:
+        done_file.writelines(f"{codename}\n" for codename in sorted(done))
+    return subset, done
+
+
+def write_tile(subset, subset_path, codename, features, outlines, attrs, chunks, compression):
+    group = subset.create_group(codename)
+    for feature, data in (("features", features), ("outlines", outlines)):
+        chunk = chunks.get(feature)
+        if chunk:
+            chunk = tuple(min(size or dim, dim) for size, dim in zip(chunk, data.shape))
+        group.create_dataset(feature, data=data, chunks=chunk, compression=compression.get(feature))
+    for key, value in attrs.items():
+        group.attrs[key] = value
+    subset.flush()
+    with open(_done_path(subset_path), "a") as done_file:
+        done_file.write(f"{codename}\n")
+
+
+def create_subsets(
+    data_folder, output_folder=None, mins_maxs_path=None, patch_size=384, n_classes=2,
+    n_workers=4, chunks=None, compression=None, dtype=np.float32, seed=42, overwrite=False
+):
+    output_folder = output_folder or data_folder
+
+    # chunks default to a third of a patch side with full depth, so a random patch touches
+    # at most four chunks per axis
+    chunk_size = max(patch_size // 3, 1)
+    chunks = chunks if chunks is not None else {
+        "features": (chunk_size, chunk_size, None),
+        "outlines": (chunk_size, chunk_size, n_classes),
+    }
+    if not isinstance(compression, dict):
+        compression = {"features": compression, "outlines": compression}
+
+    mins, maxs = None, None
+    if mins_maxs_path is not None:
+        with open(mins_maxs_path, "rb") as min_max_file:
+            mins, maxs = pickle.load(min_max_file)
+        mins, maxs = np.asarray(mins, dtype=dtype), np.asarray(maxs, dtype=dtype)
+
+    # read region tiles and make the split
+    regions = os.listdir(os.path.join(data_folder, "vector"))
+    region_tiles = {
+        region: geopandas.read_file(os.path.join(data_folder, "vector", region, "tiles.shp"))
+        for region in regions
+    }
+    split = split_tiles(region_tiles, seed=seed)
+
+    subset_paths = {subset: os.path.join(output_folder, f"{subset}.hdf5") for subset in SUBSETS}
+    _check_overwrite(subset_paths.values(), overwrite)
+    subsets, done = {}, set()
+    for subset in SUBSETS:
+        subsets[subset], subset_done = _open_subset(subset_paths[subset])
+        done |= subset_done
+
+    tasks = []
+    for region in regions:
+        stack_path = os.path.join(data_folder, "raster", region, "stack.tif")
+        outlines_path = os.path.join(data_folder, "raster", region, "outlines.tif")
+        tiles = region_tiles[region]
+        for codename, geometry in zip(tiles["codename"], tiles["geometry"]):
+            if codename in done:
+                continue
+            subset = next(_ for _ in SUBSETS if codename in split[_])
+            tasks.append((subset, codename, stack_path, outlines_path, geometry.bounds))
+
+    # workers crop and curate tiles, this process is the only writer
+    with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+        pending = {}
+        tasks = iter(tasks)
+        while True:
+            for subset, codename, stack_path, outlines_path, bounds in tasks:
+                future = executor.submit(
+                    crop_tile, stack_path, outlines_path, bounds, patch_size, n_classes, mins, maxs, dtype
+                )
+                pending[future] = (subset, codename)
+                if len(pending) >= 2 * n_workers:
+                    break
+            if not pending:
+                break
+            finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                subset, codename = pending.pop(future)
+                features, outlines, attrs = future.result()
+                write_tile(
+                    subsets[subset], subset_paths[subset], codename, features, outlines, attrs,
+                    chunks, compression
+                )
+
+    for subset in subsets.values():
+        subset.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_folder", help="Path to folder with vector/<region>/tiles.shp and raster/<region>/*.tif")
+    parser.add_argument("--output_folder", default=None, help="Path to folder for train/val/test .hdf5 files")
+    parser.add_argument("--mins_maxs_path", default=None, help="Path to .pickle with mins and maxs for normalization")
+    parser.add_argument("--patch_size", default=384, type=int, help="Patch size used for padding and chunking")
+    parser.add_argument("--n_classes", default=2, type=int, help="Number of classes in outlines")
+    parser.add_argument("--n_workers", default=4, type=int, help="Number of processes cropping tiles")
+    parser.add_argument("--compression", default=None, help="HDF5 compression filter, e.g. gzip or lzf")
+    parser.add_argument("--overwrite", action="store_true", help="Rebuild existing subsets that have no .done log")
+    args = parser.parse_args()
+
+    create_subsets(
+        args.data_folder, args.output_folder, args.mins_maxs_path, args.patch_size, args.n_classes,
+        args.n_workers, compression=args.compression, overwrite=args.overwrite
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,3 +5,27 @@ def norm_to_vis(image, p=(2, 98)):
     p_l = np.percentile(image, p[0], axis=(0, 1))
     p_r = np.percentile(image, p[1], axis=(0, 1))
     return (image - p_l) / (p_r - p_l)
+
+
+def normalize(array, mins, maxs, out=None, chunk_size=2**16):
+    # (array - mins) / (maxs - mins) with NaN and Inf replaced by 0, computed as a per-band
+    # affine map over cache-sized chunks so no full-size temporaries are created
+    if out is None:
+        out = np.empty(array.shape, dtype=np.float32)
+    if not out.flags.c_contiguous:
+        out[...] = normalize(array, mins, maxs, chunk_size=chunk_size)
+        return out
+    mins = np.asarray(mins, dtype=np.float64)
+    ranges = np.asarray(maxs, dtype=np.float64) - mins
+    scale = np.divide(1, ranges, out=np.zeros_like(ranges), where=ranges != 0)
+    scale, offset = scale.astype(out.dtype), (-mins * scale).astype(out.dtype)
+
+    depth = array.shape[-1]
+    array_flat, out_flat = array.reshape((-1, depth)), out.reshape((-1, depth))
+    n_rows = max(chunk_size // depth, 1)
+    for start in range(0, len(out_flat), n_rows):
+        chunk = out_flat[start:start + n_rows]
+        np.multiply(array_flat[start:start + n_rows], scale, out=chunk, casting="unsafe")
+        np.add(chunk, offset, out=chunk)
+        np.nan_to_num(chunk, copy=False, nan=0, posinf=0, neginf=0)
+    return out
@@ -0,0 +1 @@
+from utils.stats.stats import *
@@ -0,0 +1,196 @@
+import concurrent.futures
+import rasterio
+import rasterio.windows
+import numpy as np
+import argparse
+import pickle
+import json
+
+
+STATISTICS_VERSION = 1
+
+_rasters = {}
+
+
+class BandStatistics:
+    def __init__(self, n_bands, bins=None, hist_range=None):
+        self.n_bands = n_bands
+        self.count = np.zeros(n_bands, dtype=np.int64)
+        self.mean = np.zeros(n_bands)
+        self.m2 = np.zeros(n_bands)
+        self.mins = np.full(n_bands, np.inf)
+        self.maxs = np.full(n_bands, -np.inf)
+        self.bins = bins
+        self.hist_range = None if hist_range is None else np.asarray(hist_range, dtype=float)
+        self.histograms = None if bins is None else np.zeros((n_bands, bins), dtype=np.int64)
+
+    @property
+    def variance(self):
+        return np.where(self.count > 1, self.m2 / np.maximum(self.count, 1), 0.0)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def update(self, block, nodata=None):
+        # block is (bands, rows, cols) as read by rasterio, invalid pixels are ignored per band
+        block = np.asarray(block, dtype=np.float64).reshape((self.n_bands, -1))
+        valid = np.isfinite(block)
+        if nodata is not None:
+            valid &= block != nodata
+        count = valid.sum(axis=1)
+        values = np.where(valid, block, 0.0)
+        mean = values.sum(axis=1) / np.maximum(count, 1)
+        m2 = (np.where(valid, block - mean[:, np.newaxis], 0.0)**2).sum(axis=1)
+        other = BandStatistics(self.n_bands)
+        other.count, other.mean, other.m2 = count, mean, m2
+        other.mins = np.where(valid, block, np.inf).min(axis=1)
+        other.maxs = np.where(valid, block, -np.inf).max(axis=1)
+        if self.histograms is not None:
+            other.bins, other.hist_range = self.bins, self.hist_range
+            # bands without a single valid pixel have no range, their histograms stay empty
+            other.histograms = np.zeros((self.n_bands, self.bins), dtype=np.int64)
+            for band in np.flatnonzero(np.isfinite(self.hist_range).all(axis=1)):
+                other.histograms[band] = np.histogram(
+                    block[band][valid[band]], self.bins, tuple(self.hist_range[band])
+                )[0]
+        self.merge(other)
+
+    def merge(self, other):
+        # Chan et al. pairwise update, exact for any split of the data
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        safe_count = np.maximum(count, 1)
+        self.mean = self.mean + delta * other.count / safe_count
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / safe_count
+        self.count = count
+        self.mins = np.minimum(self.mins, other.mins)
+        self.maxs = np.maximum(self.maxs, other.maxs)
+        if self.histograms is not None and other.histograms is not None:
+            self.histograms = self.histograms + other.histograms
+        return self
+
+    def to_dict(self):
+        statistics = {
+            "version": STATISTICS_VERSION,
+            "n_bands": self.n_bands,
+            "count": self.count.tolist(),
+            "mean": self.mean.tolist(),
+            "variance": self.variance.tolist(),
+            "min": self.mins.tolist(),
+            "max": self.maxs.tolist(),
+        }
+        if self.histograms is not None:
+            statistics["histograms"] = {
+                "bins": self.bins,
+                "range": self.hist_range.tolist(),
+                "counts": self.histograms.tolist(),
+            }
+        return statistics
+
+    @classmethod
+    def from_dict(cls, statistics):
+        if statistics["version"] != STATISTICS_VERSION:
+            raise ValueError(f"Unsupported statistics version {statistics['version']}")
+        histograms = statistics.get("histograms")
+        if histograms is None:
+            band_statistics = cls(statistics["n_bands"])
+        else:
+            band_statistics = cls(statistics["n_bands"], histograms["bins"], histograms["range"])
+            band_statistics.histograms = np.array(histograms["counts"], dtype=np.int64)
+        band_statistics.count = np.array(statistics["count"], dtype=np.int64)
+        band_statistics.mean = np.array(statistics["mean"])
+        band_statistics.m2 = np.array(statistics["variance"]) * band_statistics.count
+        band_statistics.mins = np.array(statistics["min"])
+        band_statistics.maxs = np.array(statistics["max"])
+        return band_statistics
+
+    def save(self, path):
+        with open(path, "w") as statistics_file:
+            json.dump(self.to_dict(), statistics_file, indent=2)
+
+
+def load_statistics(path):
+    # legacy mins_maxs.pickle files only carry the per-band range
+    if path.endswith(".pickle"):
+        with open(path, "rb") as min_max_file:
+            mins, maxs = pickle.load(min_max_file)
+        band_statistics = BandStatistics(len(mins))
+        band_statistics.mins = np.asarray(mins, dtype=float)
+        band_statistics.maxs = np.asarray(maxs, dtype=float)
+        return band_statistics
+    with open(path, "r") as statistics_file:
+        return BandStatistics.from_dict(json.load(statistics_file))
+
+
+def _open_raster(path):
+    # every worker process keeps its own handles open across windows
+    if path not in _rasters:
+        _rasters[path] = rasterio.open(path, "r")
+    return _rasters[path]
+
+
+def block_windows(path, window_size):
+    with rasterio.open(path, "r") as src:
+        height, width = src.height, src.width
+    return [
+        rasterio.windows.Window(
+            col_off, row_off, min(window_size, width - col_off), min(window_size, height - row_off)
+        )
+        for row_off in range(0, height, window_size)
+        for col_off in range(0, width, window_size)
+    ]
+
+
+def window_statistics(path, window, bins=None, hist_range=None, ignore_nodata=False):
+    # like masked_invalid only NaN and inf are skipped by default, stack.tif inherits nodata 0
+    # from the mosaics and zeros are valid values there, e.g. flat slope
+    src = _open_raster(path)
+    band_statistics = BandStatistics(src.count, bins, hist_range)
+    band_statistics.update(src.read(window=window), src.nodata if ignore_nodata else None)
+    return band_statistics
+
+
+def _reduce(paths, window_size, n_workers, bins=None, hist_range=None, ignore_nodata=False):
+    with rasterio.open(paths[0], "r") as src:
+        total = BandStatistics(src.count, bins, hist_range)
+    with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+        futures = [
+            executor.submit(window_statistics, path, window, bins, hist_range, ignore_nodata)
+            for path in paths
+            for window in block_windows(path, window_size)
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            total.merge(future.result())
+    return total
+
+
+def compute_statistics(paths, window_size=2048, n_workers=4, bins=None, ignore_nodata=False):
+    statistics = _reduce(paths, window_size, n_workers, ignore_nodata=ignore_nodata)
+    if bins:
+        # histogram edges need the global range, so they take a second streaming pass
+        hist_range = np.stack([statistics.mins, statistics.maxs], axis=-1)
+        histograms = _reduce(paths, window_size, n_workers, bins, hist_range, ignore_nodata)
+        statistics.bins, statistics.hist_range = bins, hist_range
+        statistics.histograms = histograms.histograms
+    return statistics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_path", help="Path to output .json statistics file")
+    parser.add_argument("input_paths", nargs="*", help="Paths to stack .tif files of all regions")
+    parser.add_argument("--window_size", default=2048, type=int, help="Size of blocks read at once")
+    parser.add_argument("--n_workers", default=4, type=int, help="Number of processes reading blocks")
+    parser.add_argument("--bins", default=None, type=int, help="Number of histogram bins, no histograms if not set")
+    parser.add_argument("--ignore_nodata", action="store_true", help="Skip pixels equal to the nodata value of the raster")
+    args = parser.parse_args()
+
+    statistics = compute_statistics(
+        args.input_paths, args.window_size, args.n_workers, args.bins, args.ignore_nodata
+    )
+    statistics.save(args.output_path)
+
+
+if __name__ == "__main__":
+    main()